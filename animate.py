@@ -31,13 +31,14 @@
 
 # Import the other modules...
 from display import preview
-from transforms import times, time_delta_value, field_delta_value, \
-    per_field_value, patch_filter
+from transforms import times
 from constants import DEFAULT_COLOUR, BORDER, SCALE_WIDTH, GRAPH_RATIO, \
     GRAPH_MAX_HEIGHT, MAP_COLOUR_LIST
-from models import Model, Values, Graphable, Graph, Domain
+from models import Model, Values, Graphable, Graph, Domain, \
+    group_graphables, model_key
 from widgets import TextWidget, DynamicTextWidget, ScaleWidget, ValuesWidget, \
     GraphWidget
+from helpers import ThreadedDict
 # We use pygame for font rendering, and for Rects.
 import pygame, pygame.font
 
@@ -77,8 +78,11 @@ def gen_widgets(panels, dates, font, edge_render, sf):
     
     return widgets
 
-def render_widgets(surface, widgets, surf_w, surf_h, index, label_rect):
-    """ Render the widgets """
+def render_widgets(render, widgets, surf_w, surf_h, label_rect):
+    """ Render the widgets.
+        render is called with a widget, a position function, and the size for
+        dynamically sized widgets, and returns the rect rendered to.
+    """
 
     # TODO: Currently we manually place all the widgets, and attempt to be
     #       intelligent about their positioning so that they do not clip.
@@ -104,7 +108,7 @@ def render_widgets(surface, widgets, surf_w, surf_h, index, label_rect):
         # Render the description.
         # We use the maximum of desc_offset and x_offset to avoid
         # clipping, if possible.
-        desc_rect = widget_set['desc'].render(surface, index, \
+        desc_rect = render(widget_set['desc'], \
             lambda size: (max(x_offset + (value_area[0] / 2) - \
                 (size[0] / 2), desc_offset), BORDER))
         # Update the description offset.
@@ -130,7 +134,7 @@ def render_widgets(surface, widgets, surf_w, surf_h, index, label_rect):
                 min(value_area[0] - (BORDER + SCALE_WIDTH), \
                     value_area[1] - (desc_rect.height + BORDER * 2 + \
                     graph_height)))
-            scale_rect = widget_set['scale'].render(surface, index, \
+            scale_rect = render(widget_set['scale'], \
                 lambda size: (x_offset, (lowest + surf_h - \
                     (BORDER + graph_height) - size[1]) / 2), scale_size)
             dirty.append(scale_rect)
@@ -142,7 +146,7 @@ def render_widgets(surface, widgets, surf_w, surf_h, index, label_rect):
         # offsets are calculated accordingly.
         map_size = (value_area[0] - (scale_rect.width + BORDER), \
             value_area[1] - (desc_rect.height + BORDER * 2 + graph_height))
-        map_rect = widget_set['map'].render(surface, index, \
+        map_rect = render(widget_set['map'], \
             lambda size: (scale_rect.right + BORDER + \
                     ((map_size[0] - size[0]) / 2), \
                 (lowest + surf_h - (BORDER + graph_height) - size[1]) / 2), \
@@ -155,16 +159,224 @@ def render_widgets(surface, widgets, surf_w, surf_h, index, label_rect):
             
         # Render the graph, if it is defined.
         if 'graph' in widget_set:
-            graph_rect = widget_set['graph'].render(surface, index, \
+            graph_rect = render(widget_set['graph'], \
                 lambda size: (x_offset, lowest), \
                 (value_area[0], max(surf_h - (lowest + BORDER), graph_height)))
             dirty.append(graph_rect)
 
     return dirty
 
+class Compositor():
+    """ Renders frames in layers. Static widgets (and the static parts of
+        dynamic widgets) are rendered once for each surface size into a
+        cached background; each frame then copies the background and
+        renders only the dynamic widgets over it.
+    """
+
+    def __init__(self, layout):
+        """ Initialise self.
+            layout is called with a render function, and the surface width
+            and height, and should render every widget using the render
+            function (see render_widgets).
+        """
+
+        self.layout = layout
+        self.size = None # The size of the cached layers.
+        self.background = None # The static layer.
+        self.dynamic = [] # The dynamic layer (render, pos_func, args).
+        self.target = None # The surface last rendered to.
+        self.time = None # The time last rendered.
+        self.last = [] # The rects last rendered to by the dynamic layer.
+
+    def render(self, surface, time):
+        """ Render the given time onto the surface, returning a list of the
+            rects changed.
+            If the surface is the one last rendered to, only the areas
+            rendered to by the dynamic widgets are changed, so the surface
+            must not have been changed since. If it already shows the given
+            time, nothing is changed.
+        """
+
+        # Regenerate the layers for a new size.
+        if surface.get_size() != self.size:
+            self.gen_layers(surface, time)
+            self.target = None
+
+        if surface is self.target and time == self.time:
+            # This is a repeat of the last frame (eg from the timewarp).
+            return []
+        elif surface is self.target:
+            # Restore the background under the last dynamic widgets.
+            dirty = self.last
+            for rect in dirty:
+                surface.blit(self.background, rect, rect)
+        else:
+            # Copy the whole background.
+            surface.blit(self.background, (0, 0))
+            dirty = [surface.get_rect()]
+        
+        # Render the dynamic widgets.
+        rects = [render(surface, time, pos_func, *args) \
+            for render, pos_func, args in self.dynamic]
+        rects = [rect.copy() for rect in rects if rect != None]
+        self.target = surface
+        self.time = time
+        self.last = rects
+        return dirty + [rect for rect in rects if rect not in dirty]
+
+    def gen_layers(self, surface, time):
+        """ Lay out the widgets, rendering the static layer, and saving the
+            dynamic widgets with their positions.
+        """
+
+        # We use the same format as the surface for quick blits.
+        size = surface.get_size()
+        background = pygame.Surface(size, 0, surface)
+        background.fill(DEFAULT_COLOUR)
+        # Dynamic widgets are laid out on a scratch surface, so that they do
+        # not leave anything behind on the background.
+        scratch = pygame.Surface(size, 0, surface)
+        dynamic = []
+
+        def render(widget, pos_func, *args):
+            """ Render the given widget onto the right layer """
+            pos_func = fixed_position(pos_func)
+            if hasattr(widget, 'render_static'):
+                # Render the static part now, and the dynamic part later.
+                dynamic.append((widget.render_dynamic, pos_func, args))
+                return widget.render_static(background, pos_func, *args)
+            elif widget.dynamic:
+                # render_dynamic, if present, returns the rect changed, which
+                # may differ from the rect used for the layout.
+                dynamic.append((getattr(widget, 'render_dynamic', \
+                    widget.render), pos_func, args))
+                return widget.render(scratch, time, pos_func, *args)
+            else:
+                return widget.render(background, time, pos_func, *args)
+        self.layout(render, *size)
+
+        # Save the layers.
+        self.size = size
+        self.background = background
+        self.dynamic = dynamic
+
+
+def fixed_position(pos_func):
+    """ Return a wrapper for the given position function that only calls it
+        once for any given size. The position functions used when laying out
+        the widgets refer to variables that change as the layout continues,
+        so they need to be resolved as they are laid out.
+    """
+    positions = {}
+    def wrapper(size):
+        key = tuple(size)
+        if key not in positions:
+            positions[key] = pos_func(size)
+        return positions[key]
+    return wrapper
+
+def gen_panels(spec, values = None):
+    """ Generate a list of panels, with their domains, from a panel spec.
+        Panel specs only contain simple (picklable) values, so that other
+        processes can regenerate the same panels. A panel spec is a list of
+        dicts, each with:
+        - 'values': a ((gis, csv), field, transforms) key for the Values.
+        - 'desc': the description.
+        - 'map_domain': the map's domain id, or None for a new domain.
+        - 'graph': None, or a dict with:
+            - 'values': a key (as above) for the graph's Values.
+            - 'statistics': a list of the statistics to graph.
+            - 'label': the graph's label.
+            - 'line_label': the label for the line, or for per-field graphs,
+              a format string for the label for each field.
+            - 'per_field': True for one line per field.
+            - 'envelope': True to show per-field graphs as an envelope.
+            - 'domain': the graph's domain id, or None for a new domain.
+        values maps the keys to Values objects; by default, the Values (and
+        Models) are loaded as required.
+    """
+
+    if values == None:
+        models = ThreadedDict(lambda name: Model(*name, fields = ()))
+        values = ThreadedDict(lambda key: Values(models[key[0]], key[1], \
+            transforms = key[2]))
+
+    panels = []
+    domains = {} # id: ([items], colour)
+    for panel_spec in spec:
+        map_domain_id = panel_spec.get('map_domain')
+        if map_domain_id == None:
+            map_domain_id = len(domains)
+        value = values[panel_spec['values']]
+        panel = {'values': value, 'desc': panel_spec['desc']}
+
+        graph_spec = panel_spec.get('graph')
+        if graph_spec != None:
+            graph_domain_id = graph_spec.get('domain')
+            if graph_domain_id == None:
+                graph_domain_id = len(domains) + 1
+            graph_value = values[graph_spec['values']]
+            if graph_spec['per_field']:
+                # Multiple, per-field graphs, calculated together.
+                graphs = group_graphables(graph_value, \
+                    value.model.get_patch_fields(), \
+                    statistics = graph_spec['statistics'], \
+                    label = graph_spec['line_label'])
+            else:
+                # Just one graph.
+                graphs = [Graphable(graph_value, graph_spec['line_label'], \
+                    statistics = graph_spec['statistics'])]
+            graph = Graph(graphs, label = graph_spec['label'], \
+                envelope = graph_spec['envelope'])
+            panel['graphs'] = graph
+            # Add the graph to the domain list.
+            if graph_domain_id in domains:
+                domains[graph_domain_id][0].append(graph)
+            else:
+                domains[graph_domain_id] = ([graph], False)
+
+        # Add the map to the domains.
+        domains[map_domain_id] = (domains.get(map_domain_id, \
+            ([], True))[0] + [value], True)
+
+        panels.append(panel)
+
+    # Initialise the domains.
+    i = 0
+    for items, coloured in domains.values():
+        if coloured:
+            Domain(items, MAP_COLOUR_LIST[i])
+            i += 1
+        else:
+            Domain(items)
+
+    return panels
+
+def gen_data_key(spec):
+    """ Return a key for the data used by the given panel spec (see
+        gen_panels), which changes whenever any of the model files change.
+    """
+
+    models = set()
+    for panel_spec in spec:
+        models.add(tuple(panel_spec['values'][0]))
+        if panel_spec.get('graph') != None:
+            models.add(tuple(panel_spec['graph']['values'][0]))
+    return [[gis, csv, model_key(gis, csv)] for gis, csv in sorted(models)]
+
+def gen_spec_render_frame(spec):
+    """ Return a render_frame function and the number of frames for the given
+        render spec; a tuple of a panel spec (see gen_panels) and the
+        remaining arguments to gen_render_frame.
+    """
+    return gen_render_frame(gen_panels(spec[0]), *spec[1:])
+
 def gen_render_frame(panels, font_desc, header, timewarp, edge_render, sf):
     """ Given a list of panels, return a render_frame function showing them,
         and the number of frames.
+        render_frame returns a list of the rects that it changed; this is
+        empty if the surface already shows the frame's row, so repeated
+        frames can be reused. render_frame.frame_map maps frames to rows.
     """
 
     # Init the font.
@@ -179,33 +391,34 @@ def gen_render_frame(panels, font_desc, header, timewarp, edge_render, sf):
     label = TextWidget(header, font)
     date = DynamicTextWidget(lambda time: dates[time], font)
     
-    # Generate the render_frame function.
-    frame_map = times[timewarp]([panel['values'] for panel in panels])
-    def render_frame(surface, frame):
-        """ Render a frame """
-        
-        index = frame_map[frame] # Figure out the row index in the CSV.
-        surface.fill(DEFAULT_COLOUR) # Fill the surface.
+    def layout(render, surf_w, surf_h):
+        """ Lay out and render every widget """
         
         # TODO: Currently we manually place all the widgets, and attempt to be
         #       intelligent about their positioning so that they do not clip.
         #       It would be better if the widgets were smart enough to place
         #       themselves...
-        
-        # Cache the surface width and height for readability purposes.
-        surf_w, surf_h = surface.get_size()
 
         # Render the date and label.
         # Dirty is a list of rects rendered to.
-        dirty = [date.render(surface, index, \
+        dirty = [render(date, \
             lambda size: (surf_w - (BORDER + size[0]), BORDER))]
-        label_rect = label.render(surface, index, \
-            lambda size: (BORDER, BORDER))
+        label_rect = render(label, lambda size: (BORDER, BORDER))
         dirty.append(label_rect)
 
         # Render the widgets.
-        dirty += render_widgets(surface, widgets, surf_w, surf_h, index, \
-            label_rect)
+        dirty += render_widgets(render, widgets, surf_w, surf_h, label_rect)
+        return dirty
+    compositor = Compositor(layout)
+    
+    # Generate the render_frame function.
+    frame_map = times[timewarp]([panel['values'] for panel in panels])
+    def render_frame(surface, frame):
+        """ Render a frame """
+        
+        index = frame_map[frame] # Figure out the row index in the CSV.
+        return compositor.render(surface, index)
+    render_frame.frame_map = frame_map
             
     return render_frame, len(frame_map)
 
@@ -216,7 +429,7 @@ if __name__ == "__main__":
 
     # Create a Models.
     small = Model(os.path.join(localpath, "gis/SmallPatches"), \
-        os.path.join(localpath, "csv/small"))
+        os.path.join(localpath, "csv/small"), fields = ["SWTotal", "NO3Total"])
     # Create the values. We also include the transformation, for later use.
     values = [(Values(small, "SWTotal"), "None"),
               (Values(small, "NO3Total"), "None")]
@@ -224,10 +437,9 @@ if __name__ == "__main__":
     graphs = [Graph([Graphable(Values(small, "SWTotal"), \
             "SWTotal (min, mean, max)", \
             statistics = ['min', 'mean', 'max'])]), \
-        Graph([Graphable(Values(small, "NO3Total", \
-                transforms = [lambda v: patch_filter(v, patch_set)]), \
-            "Field #{}".format(i), statistics = ['mean']) \
-            for i, patch_set in small.get_patch_fields().items()])
+        Graph(group_graphables(Values(small, "NO3Total"), \
+            small.get_patch_fields(), statistics = ['mean'], \
+            label = "Field #{}"))
     ]
     # Create the description strings...
     descriptions = []
@@ -7,6 +7,7 @@
 ANCHOR_FORCE = 10 # Divisor for anchors, for place.
 BORDER = 20 # Empty space around the image, in pixels.
 BROKEN_COLOUR = (255, 255, 255) # Colour for patches missing data.
+COLOUR_TABLE_SIZE = 1024 # Number of precalculated colours for each domain.
 DEFAULT_COLOUR = (255, 255, 255) # Background colour.
 DEFAULT_LABEL = "Key" # Default label for graphs.
 EDGE_COLOUR = (0, 0, 0) # Colour for the edges.
@@ -27,6 +28,8 @@ ITERATION_MULTIPLIER = 2 # Multiplier for iteration; the larger the value,
 MAP_COLOUR_LIST = ((0.02, 0.24), # A list of HSV colour ranges to choose from.
     (0.36, 0.63),
     (0.7, 0.95))
+MAP_RASTER = True # Whether to fill the map from a cached image of the patches,
+                  # rather than drawing every patch for every frame.
 MAX_FPS = 24 # Maximum allowed FPS
 MIN_FPS = 1 # Minimum allowed FPS
 MAX_FRAMES_PER_DAY = 5 # Maximum number of frames per day
@@ -34,6 +37,7 @@ MIN_FRAMES_PER_DAY = 1 # Minimum number of frames per day
 MAX_TEXT_HEIGHT = 60 # Maximum text height
 MIN_TEXT_HEIGHT = 5 # Minimum text height
 PLACEMENT_CONSTANT = 1 # Minimum activity before place bails.
+PLACEMENT_METHOD = 'sweep' # The label placement method ('sweep' or 'force').
 OVERLAP_FORCE = 2 # Divisor for overlap for place.
 SCALE_MARKER_SIZE = 2 # Marker size, in pixels.
 SCALE_SPACING = 30 # Space between the values in a scale.
@@ -44,8 +48,30 @@ TEXT_AA = True # Whether or not to antialias the text.
 
 # Other:
 AREA_FIELD = "Manager_P.Script.Patch_area" # Field name for the patch areas.
+CACHED_CHUNKS = 8 # Number of transformed chunks cached for each Values.
+CACHE_SUFFIX = ".store" # Suffix for the cache next to a CSV directory.
+CHUNK_ROWS = 32 # Number of rows transformed at once.
 DATE_FIELD = "Clock.Today" # Field name for dates.
+EXPORT_FORMAT = 'png' # Default format for exported frames ('png' or 'npy').
+EXPORT_QUEUE_SIZE = 16 # Number of rendered frames waiting to be exported.
+EXPORT_WRITERS = 4 # The number of threads writing exported frames.
+FFMPEG_BINARY = None # The FFmpeg binary used to encode movies, or None to
+                     # search for one.
 FIELD_NO_FIELD = "Manager_P.Script.This_field_no" # Field name for the field.
+MOVIE_CODEC = 'libx264' # The codec used for movies.
+MOVIE_PRESET = 'medium' # The encoder speed preset, or None for the default.
+MOVIE_QUALITY = 23 # The constant rate factor for movies; lower is better, or
+                   # None for the codec's default.
+MOVIE_SEGMENT_FRAMES = 1000 # Frames in each resumable segment of a movie, or
+                            # None to render movies in one go.
 PATCH_NUMBER_FIELD = 'PN' # Field name for patch numbers (in the GIS files).
-THREAD_COUNT = 8 # The number of parallel threads to use to load the CSV files.
+PROCESS_COUNT = None # The number of processes used to parse the CSV files,
+                     # or None for one per CPU.
+RENDER_CHUNK_FRAMES = 16 # Number of consecutive frames rendered at once by a
+                         # worker process.
+RENDER_PROCESS_COUNT = None # The number of processes used to render movie
+                            # frames, or None for one per CPU.
+SEGMENT_SUFFIX = ".segments" # Suffix for the directory of movie segments.
+STORE_VERSION = 2 # Store format version; increment to invalidate old stores.
+VALUES_CACHE_SIZE = 32 # The number of transformed Values cached by the GUI.
 
@@ -3,31 +3,51 @@
     Author: Alastair Hughes
 """
 
-# We currently use MoviePy for rendering; import that.
-from moviepy.editor import VideoClip
+# Movies are encoded by piping raw frames into FFmpeg.
+import os, subprocess, shutil, json, signal, itertools
 # We use pygame for rendering... and lots of other things.
 import pygame, pygame.surfarray, pygame.transform, pygame.event, \
     pygame.display, pygame.time
 pygame.init()
 # We need some constants
-from constants import MAX_FPS, MIN_FPS
+from constants import MAX_FPS, MIN_FPS, RENDER_CHUNK_FRAMES, \
+    RENDER_PROCESS_COUNT, FFMPEG_BINARY, MOVIE_CODEC, MOVIE_PRESET, \
+    MOVIE_QUALITY, MOVIE_SEGMENT_FRAMES, SEGMENT_SUFFIX, EXPORT_FORMAT, \
+    EXPORT_QUEUE_SIZE, EXPORT_WRITERS
+# Segments are moved into place like stores.
+from store import replace
+# Exported frames are written by a pool of threads.
+from helpers import Job
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+# Frames can be rendered in parallel in other processes.
+import multiprocessing
+from collections import deque
+import numpy as np
+
+# The render_frame function and surface used by each worker process; see
+# init_worker.
+worker = {}
 
 def preview(render_frame, frames, fps, size, caption):
     """ Preview a movie in pygame, in real time.
-        The builtin MoviePy one seems broken, and this skips
-        rendering a video... usefull for development.
+        This skips rendering a video... usefull for development.
     """
     
     screen = pygame.display.set_mode(size, pygame.RESIZABLE)
     pygame.display.set_caption(caption)
     # Render an initial frame.
+    # dirty is the list of rects changed by the last render.
     frame = 0
-    render_frame(screen, 0)
+    dirty = render_frame(screen, 0)
 
     # Render all the remaining frames.
     while frame < (frames - 1):
         last_time = pygame.time.get_ticks()
-        pygame.display.update()
+        # Only update the changed parts of the display.
+        pygame.display.update(dirty)
         
         # Get any events...
         for event in pygame.event.get():
@@ -51,12 +71,11 @@ def preview(render_frame, frames, fps, size, caption):
                 screen = pygame.display.set_mode(event.dict['size'], \
                     pygame.RESIZABLE)
                 # Rerender...
-                render_frame(screen, frame)
-                pygame.display.update()
+                pygame.display.update(render_frame(screen, frame))
         
         # Render the current frame.
         frame += 1
-        render_frame(screen, frame)
+        dirty = render_frame(screen, frame)
         # Wait.
         elapsed_time = pygame.time.get_ticks() - last_time
         time_per_frame = 1000 / fps
@@ -65,24 +84,451 @@ def preview(render_frame, frames, fps, size, caption):
         else:
             pygame.time.wait(int(time_per_frame - elapsed_time))
 
-def render(render_frame, frames, fps, size, filename):
-    """ Create a movie using the given render_frame function """
-    
-    # Wrapper so that the render function gets passed a surface to draw to,
-    # and a frame number.
-    def make_frame(t):
+def init_worker(spec, size):
+    """ Initialise a worker process for rendering frames, using the given
+        render spec (see animate.gen_spec_render_frame) and frame size.
+    """
+    # SDL handles SIGTERM (see pygame.init), which stops the pool from
+    # terminating the worker; restore the default handler.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # This is imported here, as animate imports this module.
+    from animate import gen_spec_render_frame
+    worker['render_frame'] = gen_spec_render_frame(spec)[0]
+    # Reuse the surface, so that only the changed parts of each frame are
+    # rendered.
+    worker['surface'] = pygame.Surface(size)
+
+def render_frames(frames):
+    """ Render the given frames in a worker process, returning the RGB data
+        for each frame as a string, or None for frames which are the same as
+        the previous frame.
+    """
+    surface = worker['surface']
+    data = []
+    for frame in frames:
+        # The first frame is always sent, as the surface may have been
+        # rendered for a frame in another chunk.
+        if len(worker['render_frame'](surface, frame)) > 0 or \
+                len(data) == 0:
+            data.append(pygame.image.tostring(surface, 'RGB'))
+        else:
+            data.append(None)
+    return data
+
+def parallel_frames(spec, frames, size, processes = RENDER_PROCESS_COUNT):
+    """ Render the given list of frames in a pool of worker processes, each
+        rebuilding the render_frame function from the given render spec.
+        This is a generator yielding a (height, width, 3) array for each
+        frame, in order.
+    """
+
+    processes = processes or multiprocessing.cpu_count()
+    # Split the frames into runs of consecutive frames, which are each
+    # rendered by a single worker.
+    chunks = iter([frames[i:i + RENDER_CHUNK_FRAMES] \
+        for i in range(0, len(frames), RENDER_CHUNK_FRAMES)])
+    pool = multiprocessing.Pool(processes, init_worker, (spec, size))
+    # Only queue a couple of chunks per process at once, so that the
+    # rendered frames do not pile up in memory if the encoder is slow.
+    pending = deque()
+    try:
+        def queue_chunk():
+            for chunk in chunks:
+                pending.append(pool.apply_async(render_frames, (chunk,)))
+                break
+        for i in range(processes * 2):
+            queue_chunk()
+        while len(pending) > 0:
+            data = pending.popleft().get()
+            queue_chunk()
+            for frame in data:
+                # Repeated frames reuse the last array.
+                if frame != None:
+                    array = np.frombuffer(frame, dtype=np.uint8).reshape( \
+                        (size[1], size[0], 3))
+                yield array
+    finally:
+        # Wait for any queued chunks before stopping; terminating the pool
+        # while a worker is sending back frames can deadlock.
+        pool.close()
+        for result in pending:
+            result.wait()
+        pool.join()
+
+def ffmpeg_binary():
+    """ Return the FFmpeg binary to use for encoding movies """
+    if FFMPEG_BINARY != None:
+        return FFMPEG_BINARY
+    if 'FFMPEG_BINARY' in os.environ:
+        return os.environ['FFMPEG_BINARY']
+    # Use the binary shipped with imageio, if available.
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except (ImportError, RuntimeError):
+        return 'ffmpeg'
+
+
+class MovieWriter():
+    """ Write raw RGB frames into an FFmpeg process, which encodes them into
+        a movie.
+    """
+
+    def __init__(self, filename, size, fps, codec = MOVIE_CODEC, \
+            quality = MOVIE_QUALITY, preset = MOVIE_PRESET):
+        """ Initialise self.
+            quality is the constant rate factor; lower is better, and None
+            uses the codec's default. preset is the encoder speed preset, or
+            None for the default.
+        """
+
+        self.size = size
+        # A (height, width, 3) buffer for frames that need rearranging.
+        self.buffer = np.empty((size[1], size[0], 3), dtype=np.uint8)
+        self.copied = False # Whether the buffer holds a copied surface.
+        # Generate the command; the raw frames are read from stdin.
+        command = [ffmpeg_binary(), '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-vcodec', 'rawvideo',
+            '-s', '{}x{}'.format(*size), '-pix_fmt', 'rgb24',
+            '-r', str(fps), '-i', '-', '-an', '-vcodec', codec]
+        if quality != None:
+            command.extend(['-crf', str(quality)])
+        if preset != None:
+            command.extend(['-preset', preset])
+        # Most players only support yuv420p, which needs even dimensions.
+        command.extend(['-pix_fmt', 'yuv420p', \
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', filename])
+        self.process = subprocess.Popen(command, stdin = subprocess.PIPE)
+
+    def write_array(self, array):
+        """ Write a (height, width, 3) uint8 frame """
+        try:
+            self.process.stdin.write(np.ascontiguousarray(array).data)
+        except (IOError, OSError) as e:
+            # FFmpeg has probably exited; report the error from close.
+            self.close()
+            raise IOError("Failed to write a frame ({})".format(e))
+
+    def write_surface(self, surface, changed = True):
+        """ Write the contents of the given surface.
+            If changed is False, the surface has not changed since it was
+            last written, so the last copy is written again.
+        """
+        if changed or not self.copied:
+            # pixels3d is an (x, y) view of the surface; transpose it to
+            # (y, x) and copy it into the buffer, avoiding any new full frame
+            # copies.
+            view = pygame.surfarray.pixels3d(surface)
+            np.copyto(self.buffer, view.transpose(1, 0, 2))
+            # Release the view, which locks the surface.
+            del view
+            self.copied = True
+        self.write_array(self.buffer)
+
+    def close(self):
+        """ Finish writing the movie, raising an IOError if FFmpeg failed """
+        if self.process.stdin.closed:
+            return
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise IOError("FFmpeg failed with exit code {}!".format( \
+                self.process.returncode))
+
+
+def write_rendered(writer, render_frame, surface, frames):
+    """ Render the given frames onto the given surface, writing each of them
+        with the given MovieWriter.
+    """
+    for frame in frames:
+        # Repeated frames (eg from the timewarp) change nothing.
+        writer.write_surface(surface, len(render_frame(surface, frame)) > 0)
+
+def write_arrays(writer, arrays, count):
+    """ Write the next count arrays from the given iterator with the given
+        MovieWriter.
+    """
+    for i in range(count):
+        writer.write_array(next(arrays))
+
+def encode_segment(filename, size, fps, codec, quality, write, *args):
+    """ Encode a segment into the given file, calling write with a
+        MovieWriter and the given arguments to write the frames. Returns the
+        size of the file.
+        The movie is written to a temporary file which is moved into place
+        once it is complete, so the file is never partially written.
+    """
+
+    root, ext = os.path.splitext(filename)
+    temp = root + ".tmp" + ext
+    writer = MovieWriter(temp, size, fps, codec, quality)
+    try:
+        write(writer, *args)
+    finally:
+        writer.close()
+    replace(temp, filename)
+    return os.path.getsize(filename)
+
+def load_manifest(filename, key, default):
+    """ Load the data saved in the given manifest file, returning default if
+        the manifest is missing or is for a different key.
+    """
+
+    try:
+        with open(filename) as manifest:
+            manifest = json.load(manifest)
+    except (IOError, OSError, ValueError):
+        return default
+    if manifest.get('key') != key:
+        print("Manifest {} is out of date".format(filename))
+        return default
+    return manifest['data']
+
+def save_manifest(filename, key, data):
+    """ Save the given key and (JSON serialisable) data to the given
+        manifest file.
+    """
+    temp = filename + ".tmp"
+    with open(temp, 'w') as manifest:
+        json.dump({'key': key, 'data': data}, manifest)
+    replace(temp, filename)
+
+def render_segments(render_frame, frames, fps, size, filename, spec = None, \
+        processes = RENDER_PROCESS_COUNT, codec = MOVIE_CODEC, \
+        quality = MOVIE_QUALITY, segment_frames = MOVIE_SEGMENT_FRAMES):
+    """ Create a movie by rendering segments of segment_frames frames, and
+        then joining them together.
+        The segments and a manifest are kept in a directory next to the
+        movie until it is complete. If a render spec is given (see
+        animate.gen_spec_render_frame), segments which are already complete
+        for the same spec and model files are skipped, so an interrupted
+        render can be resumed, and the frames are rendered in parallel by the
+        given number of worker processes (None for one per CPU). Without a
+        spec, the existing segments cannot be checked, so every segment is
+        rendered.
+    """
+
+    # This is imported here, as animate imports this module.
+    from animate import gen_data_key
+
+    directory = filename + SEGMENT_SUFFIX
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    manifest_file = os.path.join(directory, 'manifest.json')
+    # The manifest maps segment filenames to (frame range, file size).
+    segments = {}
+    if spec != None:
+        # The key is normalised to match the saved (JSON) version.
+        key = json.loads(json.dumps({'frames': frames, 'fps': fps, \
+            'size': size, 'codec': codec, 'quality': quality, \
+            'segment_frames': segment_frames, 'spec': spec, \
+            'data': gen_data_key(spec[0])}))
+        for name, (segment_range, segment_size) in \
+                load_manifest(manifest_file, key, {}).items():
+            segments[name] = (tuple(segment_range), segment_size)
+
+    # Find the segments, and the (filename, frames) jobs for any which are
+    # missing.
+    ext = os.path.splitext(filename)[1]
+    names = []
+    jobs = []
+    for index, start in enumerate(range(0, frames, segment_frames)):
+        name = "{:06d}{}".format(index, ext)
+        names.append(name)
+        segment_range = (start, min(start + segment_frames, frames))
+        path = os.path.join(directory, name)
+        if segments.get(name, (None, None))[0] == segment_range and \
+                os.path.isfile(path) and \
+                os.path.getsize(path) == segments[name][1]:
+            # This segment is complete.
+            continue
+        jobs.append((path, list(range(*segment_range))))
+    if len(jobs) < len(names):
+        print("Skipping {} complete segments".format(len(names) - len(jobs)))
+
+    def add_segment(path, job_frames, segment_size):
+        """ Record the given complete segment in the manifest """
+        segments[os.path.basename(path)] = \
+            ((job_frames[0], job_frames[-1] + 1), segment_size)
+        if spec != None:
+            save_manifest(manifest_file, key, segments)
+
+    if len(jobs) == 0:
+        # Every segment is complete, so there is nothing to render; don't
+        # start any workers.
+        pass
+    elif spec != None and (processes or multiprocessing.cpu_count()) > 1:
+        # Render the frames of every missing segment in other processes,
+        # streaming them back in order, and encode each segment here.
+        rendered = parallel_frames(spec, [frame \
+            for path, job_frames in jobs for frame in job_frames], size, \
+            processes)
+        try:
+            # Start the workers before opening any encoders; otherwise, the
+            # workers inherit the encoder's input pipe, and the encoder never
+            # sees the end of its input.
+            arrays = itertools.chain([next(rendered)], rendered)
+            for path, job_frames in jobs:
+                add_segment(path, job_frames, encode_segment(path, size, \
+                    fps, codec, quality, write_arrays, arrays, \
+                    len(job_frames)))
+        finally:
+            rendered.close()
+    else:
+        # Reuse the surface, so that only the changed parts of each frame
+        # are rendered.
         surface = pygame.Surface(size)
-        render_frame(surface, int(t*fps))
-        # Flip the surface around it's x/y axis (main diagonal), to account for display
-        # issues with the movie rendering.
-        surface = pygame.transform.rotate(surface, -90)
-        surface = pygame.transform.flip(surface, True, False)
-        return pygame.surfarray.pixels3d(surface)
-    
-    # Create the animation...
-    animation = VideoClip(make_frame, duration=frames/fps)
+        for path, job_frames in jobs:
+            add_segment(path, job_frames, encode_segment(path, size, fps, \
+                codec, quality, write_rendered, render_frame, surface, \
+                job_frames))
+
+    # Join the segments together, without reencoding them.
+    list_file = os.path.join(directory, 'segments.txt')
+    with open(list_file, 'w') as segment_list:
+        for name in names:
+            segment_list.write("file '{}'\n".format(name))
+    if subprocess.call([ffmpeg_binary(), '-y', '-loglevel', 'error', \
+            '-f', 'concat', '-safe', '0', '-i', list_file, '-c', 'copy', \
+            filename]) != 0:
+        raise IOError("Failed to join the segments in {}!".format(directory))
+    # The segments are no longer needed.
+    shutil.rmtree(directory)
 
-    # Write to the movie file...
-    animation.write_videofile(filename, fps=fps)
+def render(render_frame, frames, fps, size, filename, spec = None, \
+        processes = RENDER_PROCESS_COUNT, codec = MOVIE_CODEC, \
+        quality = MOVIE_QUALITY, segment_frames = MOVIE_SEGMENT_FRAMES):
+    """ Create a movie using the given render_frame function.
+        If a render spec is given (see animate.gen_spec_render_frame), the
+        frames are rendered in parallel by the given number of worker
+        processes (None for one per CPU).
+        codec and quality are passed to MovieWriter.
+        If segment_frames is not None, the movie is rendered as resumable
+        segments (see render_segments).
+    """
+
+    if segment_frames != None:
+        return render_segments(render_frame, frames, fps, size, filename, \
+            spec, processes, codec, quality, segment_frames)
+
+    writer = MovieWriter(filename, size, fps, codec, quality)
+    try:
+        if spec != None and (processes or multiprocessing.cpu_count()) > 1:
+            # Render the frames in other processes, streaming them back in
+            # order.
+            for array in parallel_frames(spec, list(range(frames)), size, \
+                    processes):
+                writer.write_array(array)
+        else:
+            # Reuse the surface, so that only the changed parts of each frame
+            # are rendered.
+            write_rendered(writer, render_frame, pygame.Surface(size), \
+                range(frames))
+    finally:
+        writer.close()
+
+def frame_array(surface):
+    """ Return a (height, width, 3) array copy of the given surface """
+    return np.frombuffer(pygame.image.tostring(surface, 'RGB'), \
+        dtype=np.uint8).reshape((surface.get_height(), \
+            surface.get_width(), 3))
+
+def save_frame(array, filename):
+    """ Save a (height, width, 3) frame array to the given file; a raw numpy
+        array for .npy files, or otherwise an image.
+    """
+    if filename.endswith('.npy'):
+        np.save(filename, array)
+    else:
+        surface = pygame.image.frombuffer(array.tobytes(), \
+            (array.shape[1], array.shape[0]), 'RGB')
+        pygame.image.save(surface, filename)
+
+def export_frames(render_frame, frames, size, directory, \
+        format = EXPORT_FORMAT, spec = None, \
+        processes = RENDER_PROCESS_COUNT, writers = EXPORT_WRITERS):
+    """ Export the frames as a numbered sequence of images in the given
+        directory, in the given format ('png', or 'npy' for raw arrays).
+        The frames are saved by a pool of writer threads, so that rendering
+        continues while frames are being written.
+        If a render spec is given (see animate.gen_spec_render_frame), the
+        frames are rendered in parallel by the given number of worker
+        processes (None for one per CPU). Frames already exported with the
+        same spec, model files, size, and format are skipped.
+    """
+
+    # This is imported here, as animate imports this module.
+    from animate import gen_data_key
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    filename = os.path.join(directory, "{:06d}." + format)
+    manifest_file = os.path.join(directory, 'manifest.json')
+
+    # Find the frames to export. Without a spec, we cannot tell whether the
+    # existing frames are still valid, so we export everything.
+    exported = set()
+    if spec != None:
+        # The key is normalised to match the saved (JSON) version.
+        key = json.loads(json.dumps({'size': size, 'format': format, \
+            'spec': spec, 'data': gen_data_key(spec[0])}))
+        exported = set(load_manifest(manifest_file, key, []))
+    missing = [frame for frame in range(frames) if frame not in exported \
+        or not os.path.isfile(filename.format(frame))]
+    exported.intersection_update(range(frames))
+    if len(missing) < frames:
+        print("Skipping {} unchanged frames".format(frames - len(missing)))
+    if len(missing) == 0:
+        # There is nothing to render, so don't start the writers or workers.
+        return
+
+    # Start the writers. The queue is bounded so that the rendered frames do
+    # not pile up in memory if writing is slow.
+    pending = Queue(EXPORT_QUEUE_SIZE)
+    errors = []
+    def write():
+        """ Write frames from the queue until None is found """
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            frame, array = item
+            try:
+                save_frame(array, filename.format(frame))
+                exported.add(frame)
+            except Exception as e:
+                # Keep going, so that the renderer is never blocked.
+                errors.append(e)
+    threads = [Job(write) for i in range(writers)]
+    for thread in threads:
+        thread.start()
 
-    
\ No newline at end of file
+    # Render the frames.
+    if spec != None and (processes or multiprocessing.cpu_count()) > 1:
+        arrays = parallel_frames(spec, missing, size, processes)
+    else:
+        def render_arrays():
+            """ Render the missing frames, reusing the surface """
+            surface = pygame.Surface(size)
+            array = None
+            for frame in missing:
+                # Repeated frames (eg from the timewarp) reuse the last array.
+                if len(render_frame(surface, frame)) > 0 or array is None:
+                    array = frame_array(surface)
+                yield array
+        arrays = render_arrays()
+    try:
+        for index, array in enumerate(arrays):
+            if len(errors) > 0:
+                break
+            pending.put((missing[index], array))
+    finally:
+        arrays.close()
+        # Wait for the writers to finish, and save the frames written.
+        for thread in threads:
+            pending.put(None)
+        for thread in threads:
+            thread.join()
+        if spec != None:
+            save_manifest(manifest_file, key, sorted(exported))
+    if len(errors) > 0:
+        raise IOError("Failed to save a frame ({})".format(errors[0]))
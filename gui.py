@@ -12,13 +12,12 @@
 """
 
 # Local imports.
-from display import preview, render
-from animate import gen_render_frame
-from models import Model, Values, Graphable, Graph, Domain
-from constants import MAP_COLOUR_LIST, MAX_FPS, MIN_FPS, MAX_TEXT_HEIGHT, \
-    MIN_TEXT_HEIGHT, FIELD_NO_FIELD
-from transforms import field_delta_value, time_delta_value, time_culm_value, \
-    exponential_value, log_value, per_field_value, patch_filter, times
+from display import preview, render, export_frames
+from animate import gen_render_frame, gen_panels
+from models import Model, Values
+from constants import EXPORT_FORMAT, MAX_FPS, MIN_FPS, MAX_TEXT_HEIGHT, \
+    MIN_TEXT_HEIGHT, FIELD_NO_FIELD, VALUES_CACHE_SIZE
+from transforms import transformations, times
 from helpers import Job, ThreadedDict, FuncVar, ListVar
 
 # Tkinter imports
@@ -36,40 +35,16 @@ import os.path
 # Threading imports.
 from threading import Thread, Lock
 
-# Available transformations.
-# Format: {key: [func, arg1, ...]}
-# Arguments are optional, and are special strings.
-transformations = {
-    'field_delta': [field_delta_value],
-    'time_delta': [time_delta_value],
-    'time_culm': [time_culm_value],
-    'exponential': [exponential_value],
-    'log': [log_value],
-    'per_field': [per_field_value, 'fields'],
-}
-
-def get_transform_tuple(transform_config, model):
-    """ Generate the transformation tuple """
-
-    transforms = []
-    names = []
-    for values in transform_config:
-        # Find and save the name.
-        name = values['Name'].get()
-        names.append(name)
-
-        # Add the transformation.
-        func = transformations[name][0]
-        mandatory_args = [] # Mandatory arguments for the given transform.
-        for arg in transformations[name][1:]:
-            if arg == 'fields':
-                mandatory_args.append(model.get_patch_fields())
-            else:
-                raise ValueError("Unknown transform arg {}!".format(arg))
-        # Create the transformation.
-        transforms.append(lambda v: func(v, *mandatory_args))
+# Transformations available in the GUI; those needing a list of patches are
+# only used internally.
+gui_transformations = [name for name in sorted(transformations) \
+    if 'patches' not in transformations[name][1:]]
+
+def get_transform_tuple(transform_config):
+    """ Generate the transformation tuple (of specs), and a list of names """
 
-    return tuple(transforms), names
+    names = [values['Name'].get() for values in transform_config]
+    return tuple(((name,) for name in names)), names
 
 class Options(ttk.Frame):
 
@@ -439,12 +414,15 @@ class Main(ttk.Frame):
             self.pretty_error("\n".join(traceback.format_exception(*args)))
         
         # Models.
-        self.models = ThreadedDict(lambda name: Model(*name))
+        # We only load the fields in use, as they are needed.
+        self.models = ThreadedDict(lambda name: Model(*name, fields = ()))
         # Values.
         # Don't bother with early caching for this; rendering takes quite a bit
         # longer anyway...
+        # These are keyed on the model, field, and transformation specs, and
+        # only the most recently used are kept.
         self.values = ThreadedDict(lambda name: Values(self.models[name[0]], \
-            name[1], transforms = name[2]))
+            name[1], transforms = name[2]), size = VALUES_CACHE_SIZE)
         
         # Create the widgets...
         self.create_buttons()
@@ -469,10 +447,14 @@ class Main(ttk.Frame):
         lower.pack(side='bottom', fill='x')
 
         # Create the helper function...
-        def render_wrapper(button, func, *args):
-            """ Helper render wrapper """
+        def render_wrapper(button, func, output, *args, **kargs):
+            """ Helper render wrapper.
+                output is the name of the option giving the output to be
+                overwritten (see sane_values), or None.
+                If kargs contains 'spec', it is set to the render spec.
+            """
             
-            if not self.sane_values():
+            if not self.sane_values(output):
                 # Something is wrong!
                 return
             
@@ -498,24 +480,31 @@ class Main(ttk.Frame):
             # This is wrapped to ensure that the cleanup function is always
             # run.
             try:
-                # Generate self's panels.
-                panels = self.create_panels()
-                
-                # Generate the render_frame function and frame count.
-                render_frame, frames = gen_render_frame(panels, \
+                # Generate the render spec; this can be used to recreate the
+                # panels in other processes.
+                spec = (self.create_panel_spec(), \
                     (None, self.options.get('Text size')), \
                     self.options.get('Title'), self.options.get('Timewarp'), \
                     self.options.get('Edge render') == "True", \
                     self.options.get('Significant figures'))
+                # Generate self's panels.
+                panels = self.create_panels(spec[0])
+                
+                # Generate the render_frame function and frame count.
+                render_frame, frames = gen_render_frame(panels, *spec[1:])
                     
                 # Create a job wrapper to hold the lock.
                 def wrap_render(*args, **kargs):
                     with lock:
                         func(*args, **kargs)
 
+                # Pass the render spec if required.
+                if 'spec' in kargs:
+                    kargs['spec'] = spec
+
                 # Create and start the job.
                 self.render_job = Job(wrap_render, render_frame, frames, \
-                    *[self.options.get(arg) for arg in args])
+                    *[self.options.get(arg) for arg in args], **kargs)
                 self.render_job.start()
             finally:
                 # Call the cleanup function, which will reschedule itself as
@@ -529,22 +518,33 @@ class Main(ttk.Frame):
         #       disabled by default.
         preview_button = ttk.Button(lower, text = 'Preview', \
             state = 'disabled', command = lambda: \
-                render_wrapper(preview_button, preview, 'FPS', 'Dimensions', \
-                'Title'))
+                render_wrapper(preview_button, preview, None, 'FPS', \
+                'Dimensions', 'Title'))
         preview_button.pack(side = 'left')
         
         # Render button.
         render_button = ttk.Button(lower, text = 'Render', \
-            command = lambda: render_wrapper(render_button, render, 'FPS', \
-                'Dimensions', 'Movie filename'))
+            command = lambda: render_wrapper(render_button, render, \
+                'Movie filename', 'FPS', 'Dimensions', 'Movie filename', \
+                spec = None))
         render_button.pack(side = 'right')
+
+        # Export button.
+        export_button = ttk.Button(lower, text = 'Export frames', \
+            command = lambda: render_wrapper(export_button, export_frames, \
+                'Frame directory', 'Dimensions', 'Frame directory', \
+                'Frame format', spec = None))
+        export_button.pack(side = 'right')
         
         # Create the progress bar (shares the same frame).
         self.create_progressbar(lower)
 
-    def sane_values(self):
+    def sane_values(self, output = None):
         """ Sanitize the current values.
             Prints an error and returns false if the values are not sane.
+            If output is the name of the movie filename or frame directory
+            option, the user is asked to confirm overwriting any existing
+            output.
         """
 
         def wrap_get(name, message = "{name} is invalid!"):
@@ -594,21 +594,30 @@ class Main(ttk.Frame):
 Valid fields are {}.""".format(e, ", ".join(args[:-1]) + ", and " + args[-1]))
                 return False
 
-        # Check that the user *really* wants to overwrite the existing movie.
-        movie = self.options.get('Movie filename')
-        if os.path.exists(movie):
-            return tkMessageBox.askokcancel("Confirm movie filename", \
-                "Are you sure that you want to overwrite {}?".format(movie))
+        # Check that the user *really* wants to overwrite the existing output.
+        if output == 'Movie filename':
+            movie = self.options.get(output)
+            if os.path.exists(movie):
+                return tkMessageBox.askokcancel("Confirm movie filename", \
+                    "Are you sure that you want to overwrite {}?".format( \
+                    movie))
+        elif output == 'Frame directory':
+            directory = self.options.get(output)
+            if os.path.isfile(directory):
+                self.pretty_error("{} is not a directory!".format(directory))
+                return False
+            if os.path.isdir(directory) and len(os.listdir(directory)) > 0:
+                return tkMessageBox.askokcancel("Confirm frame directory", \
+                    "Are you sure that you want to overwrite the frames " \
+                    "in {}?".format(directory))
         return True
 
-    def create_panels(self):
-        """ Generate the panels from self's current config.
-            This is called from within the render_wrapper function.
+    def create_panel_spec(self):
+        """ Generate a panel spec (see animate.gen_panels) from self's current
+            config.
         """
 
-        # Create and save the panels.
-        panels = []
-        domains = {} # id: ([items], colour)
+        spec = []
         for index, config in enumerate(self.panel_list):
             gis = config['GIS files'].get()
             csv = config['CSV directory'].get()
@@ -617,23 +626,19 @@ Valid fields are {}.""".format(e, ", ".join(args[:-1]) + ", and " + args[-1]))
             per_field = config["Per-field"].get()
             map_domain_id = config["Same scales (map)"].get()
             if map_domain_id == "":
-                map_domain_id = len(domains)
+                map_domain_id = None
             graph_domain_id = config["Same scales (graph)"].get()
             if graph_domain_id == "":
-                graph_domain_id = len(domains) + 1
+                graph_domain_id = None
             name = config["Name"].get()
             # Find the value transformations and names.
             value_trans, value_tran_names = \
-                get_transform_tuple(config['Transforms'].get(), \
-                self.models[(gis, csv)])
-            value = self.values[((gis, csv), field, value_trans)]
+                get_transform_tuple(config['Transforms'].get())
             graph_trans, graph_tran_names = \
-                get_transform_tuple(config['Graph transforms'].get(), \
-                self.models[(gis, csv)])
-            panel = {'values': value}
+                get_transform_tuple(config['Graph transforms'].get())
+            panel = {'values': ((gis, csv), field, value_trans), \
+                'map_domain': map_domain_id}
             if graph != 'None':
-                graphs = []
-            
                 # Generate a list of statistics.
                 stats = []
                 for stat in graph.split("+"):
@@ -641,56 +646,37 @@ Valid fields are {}.""".format(e, ", ".join(args[:-1]) + ", and " + args[-1]))
                 stat_name = " (" + ", ".join(stats) + ") (" + \
                     " + ".join(graph_tran_names) + ")"
 
+                panel['graph'] = {'values': ((gis, csv), field, graph_trans),
+                    'statistics': stats,
+                    # Multiple, per-field graphs may be shown as lines or as
+                    # an envelope.
+                    'per_field': per_field != 'False',
+                    'envelope': per_field == 'Envelope',
+                    'domain': graph_domain_id}
                 if per_field == 'False':
                     # Just one graph.
-                    graph_value = self.values[((gis, csv), field, \
-                        graph_trans)]
-                    graphs.append(Graphable(graph_value, field + stat_name, \
-                        statistics = stats))
-                    graph_label = 'Key'
-                else:
-                    # Multiple, per-field graphs.
-                    # Figure out the available fields.
-                    fields = value.model.get_patch_fields().items()
-                    # Generate a graph for each field.
-                    for field_no, patch_set in fields:
-                        graph_value = self.values[((gis, csv), field, \
-                            tuple(list(graph_trans) + \
-                                [lambda v: patch_filter(v, patch_set)]))]
-                        graphs.append(Graphable(graph_value, str(field_no), \
-                            statistics = stats))
-                    # Set the graph label.
-                    graph_label = "Fields" + stat_name
-                
-                # Add the graph to the panel.
-                graph = Graph(graphs, label = graph_label)
-                panel['graphs'] = graph
-                # Add the graph to the domain list.
-                if graph_domain_id in domains:
-                    domains[graph_domain_id][0].append(graph)
+                    panel['graph']['label'] = 'Key'
+                    panel['graph']['line_label'] = field + stat_name
                 else:
-                    domains[graph_domain_id] = ([graph], False)
+                    panel['graph']['label'] = "Fields" + stat_name
+                    panel['graph']['line_label'] = "{}"
             # Add the description.
             panel['desc'] = config["Description string"].get().format(\
                 name = name, field = field, csv = csv, gis = gis, \
                 transform = " + ".join(value_tran_names))
 
-            # Add the map to the domains.
-            domains[map_domain_id] = (domains.get(map_domain_id, \
-                ([], True))[0] + [value], True)
+            spec.append(panel)
 
-            panels.append(panel)
+        return spec
 
-        # Initialise the domains.
-        i = 0
-        for items, coloured in domains.values():
-            if coloured:
-                Domain(items, MAP_COLOUR_LIST[i])
-                i += 1
-            else:
-                Domain(items)
+    def create_panels(self, spec = None):
+        """ Generate the panels from the given panel spec, or self's current
+            config. This is called from within the render_wrapper function.
+        """
 
-        return panels
+        if spec == None:
+            spec = self.create_panel_spec()
+        return gen_panels(spec, self.values)
         
     def create_progressbar(self, frame):
         """ Create self's progress bar """
@@ -751,13 +737,20 @@ Valid fields are {}.""".format(e, ", ".join(args[:-1]) + ", and " + args[-1]))
                 title = 'Choose the movie filename', \
                 filetypes = [('MP4', '.mp4')], defaultextension = '.mp4', \
                 initialfile = 'movie'))
+        # Add the frame export options.
+        frame_directory = tk.StringVar(value = "movies/frames")
+        self.options.add_file("Frame directory", frame_directory, \
+            lambda: tkFileDialog.askdirectory( \
+                title = 'Choose the frame directory'))
+        self.options.add_combobox("Frame format", \
+            tk.StringVar(value = EXPORT_FORMAT), ["png", "npy"])
 
     def transform_options(self, master, values):
         """ Helper for panel_options that creates the options for some
             transformations.
         """
 
-        master.add_combobox('Name', values['Name'], transformations.keys())
+        master.add_combobox('Name', values['Name'], gui_transformations)
 
     def panel_options(self, master, values):
         """ Helper for create_list that creates the options for a specific
@@ -825,15 +818,16 @@ Valid fields are {}.""".format(e, ", ".join(args[:-1]) + ", and " + args[-1]))
         add_combo("Field", [], "", postcommand = post_field)
         add_entry("Same scales (map)", "")
         add_itemlist("Transforms", self.transform_options, \
-            list(transformations.keys())[0])
+            gui_transformations[0])
 
         # Add the graph options.
         add_combo("Graph statistics", ["Mean", "Min", "Max", "Min + Max", \
-            "Min + Mean + Max", "Sum", "None"], "None")
-        add_combo("Per-field", ['True', 'False'], 'False')
+            "Min + Mean + Max", "Sum", "Median", "P10 + Median + P90", \
+            "P25 + Median + P75", "Std", "None"], "None")
+        add_combo("Per-field", ['True', 'False', 'Envelope'], 'False')
         add_entry("Same scales (graph)", "")
         add_itemlist("Graph transforms", self.transform_options, \
-            list(transformations.keys())[0])
+            gui_transformations[0])
         
     def create_lists(self):
         """ Create the lists """
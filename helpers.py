@@ -3,86 +3,39 @@
     Author: Alastair Hughes
 """
 
-from threading import BoundedSemaphore, Lock, Thread
+from threading import Lock, Thread
+from collections import OrderedDict
 import functools
+import multiprocessing
 
 # Local imports
-from constants import THREAD_COUNT
+from constants import PROCESS_COUNT
 
 
-class ThreadedGroup:
-    """ An object to keep an arbitary number of workers on an easily-split
-        task.
-    """
-    
-    def __init__(self):
-        """ Initialise self """
-        
-        self._job_count = 0 # The number of active jobs.
-        self.lock = Lock() # Lock protecting job_count...
-        self.semaphore = BoundedSemaphore(THREAD_COUNT)
-        
-    def start(self, func, *args, **kargs):
-        """ Start the given job. This will block until there are free
-            workers.
-        """
-        
-        def job_wrapper():
-            """ Run the job, then decrement the job count and release the
-                semaphore.
-            """
-            try:
-                func(*args, **kargs)
-            finally:
-                with self.lock:
-                    self._job_count -= 1
-                self.semaphore.release()
-        
-        # Create the job.
-        job = Job(job_wrapper)
-        # Acquire the semaphore and start.
-        self.semaphore.acquire()
-        with self.lock:
-            self._job_count += 1
-        job.start()
-        
-    def wait(self):
-        """ Wait until all of the jobs are finished """
-        
-        print("Waiting for jobs to finish...")
-        
-        while self.get_job_count() != 0:
-            # Block until another job ends.
-            self.semaphore.acquire()
-            
-        print("Jobs finished!")
-
-    def get_job_count(self):
-        """ Return the current job count """
-
-        with self.lock:
-            return self._job_count
-           
-
 class ThreadedDict(object):
     """ A threaded, locking, load-from-disk dict """
     
-    def __init__(self, load_func):
+    def __init__(self, load_func, size = None):
         """ Initialise self.
             load_func is the function to call to try to load a value.
+            size is the maximum number of values to keep, or None for no
+            limit; the least recently used values are dropped first.
         """
         
         # The dict of loading jobs. (name: job)
         self.job_dict = {}
         # The lock protecting self's dict.
         self.lock = Lock()
-        # Self's dict.
-        self.value_dict = {}
+        # Self's dict, ordered from the least to the most recently used.
+        self.value_dict = OrderedDict()
+        self.size = size
         # The load function takes a name, and returns the corresponding value.
         def wrapper(name):
             value = load_func(name)
             with self.lock:
                 self.value_dict[name] = value
+                self.evict()
+            return value
         self.load_func = wrapper
         
     def __getitem__(self, name):
@@ -91,31 +44,46 @@ class ThreadedDict(object):
         # See whether the value is cached.
         with self.lock:
             if name in self.value_dict:
-                # It is cached; return it!
-                return self.value_dict[name]
+                # It is cached; mark it as the most recently used, and return
+                # it!
+                value = self.value_dict.pop(name)
+                self.value_dict[name] = value
+                return value
         
         # Otherwise, cache it, wait for the job to finish, and then return.
-        self.cache(name)
-        # Wait for the job to finish.
-        self.job_dict[name].join()
-        # Now we lock, retrieve the value, and return.
-        with self.lock:
-            return self.value_dict[name]
+        # We use the job's result, as the value may have already been evicted.
+        job = self.cache(name)
+        job.join()
+        return job.result
         
     def cache(self, name):
-        """ Cache the given item, if required """
-        
-        print("Caching {}".format(name))
+        """ Cache the given item, if required, returning the loading job """
         
         # Check wether or not the item is in the process of being cached.
-        if name in self.job_dict:
-            # The item is cached or being cached; return.
-            return
-                
-        # Otherwise, start loading it and return.
-        job = Job(self.load_func, name)
-        self.job_dict[name] = job
-        job.start()
+        # This is done under the lock, as the job may be evicted, or another
+        # thread may be starting a job for the same item.
+        with self.lock:
+            if name in self.job_dict:
+                # The item is cached or being cached; return.
+                return self.job_dict[name]
+            # Otherwise, start loading it and return. The job is started
+            # before the lock is released, as other threads may join it as
+            # soon as it is in the dict; the job only takes the lock once it
+            # has loaded the value.
+            print("Caching {}".format(name))
+            job = Job(self.load_func, name)
+            self.job_dict[name] = job
+            job.start()
+            return job
+
+    def evict(self):
+        """ Drop the least recently used values until self is within its
+            size limit. The lock must be held.
+        """
+
+        while self.size != None and len(self.value_dict) > self.size:
+            name, value = self.value_dict.popitem(last = False)
+            del self.job_dict[name]
             
             
 class Job(Thread):
@@ -130,11 +98,12 @@ class Job(Thread):
         self.args = args
         self.kargs = kargs
         self.error = None
+        self.result = None # The function's return value.
         
     def run(self):
         """ Run the function """
         try:
-            self.function(*self.args, **self.kargs)
+            self.result = self.function(*self.args, **self.kargs)
         except Exception as e:
             # Save the error.
             self.error = e
@@ -149,6 +118,28 @@ class Job(Thread):
             raise self.error
 
 
+def process_map(func, items):
+    """ Return [func(item) for item in items], running func in a pool of
+        worker processes. func must be a module-level function, and the items
+        and results must be picklable.
+    """
+
+    processes = PROCESS_COUNT or multiprocessing.cpu_count()
+    # Daemonic processes (eg pool workers) cannot start their own pools.
+    if processes == 1 or len(items) < 2 or \
+            multiprocessing.current_process().daemon:
+        return [func(item) for item in items]
+
+    pool = multiprocessing.Pool(min(processes, len(items)))
+    try:
+        # Hand out the items in a few chunks per process to reduce overheads.
+        chunksize = max(len(items) // (processes * 4), 1)
+        return pool.map(func, items, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
 class FuncVar():
     """ A stupid 'variable', supporting set and get methods """
 
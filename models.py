@@ -3,15 +3,19 @@
     Author: Alastair Hughes
 """
 
-from constants import AREA_FIELD, DATE_FIELD, DEFAULT_LABEL, FIELD_NO_FIELD, \
-    PATCH_NUMBER_FIELD
+from constants import AREA_FIELD, BROKEN_COLOUR, COLOUR_TABLE_SIZE, \
+    DATE_FIELD, DEFAULT_LABEL, FIELD_NO_FIELD, PATCH_NUMBER_FIELD
 
 # To find and load the CSV model files, we need some functions.
 from os import listdir
 import os.path
 import re
 import csv
-from helpers import ThreadedGroup, cache
+import functools
+from threading import Lock
+from helpers import cache, process_map
+from store import cache_filename, cache_key, load_cache, save_cache, \
+    open_store, save_store
 
 # shapefile is used to open the GIS files.
 import shapefile
@@ -19,13 +23,32 @@ import shapefile
 # colorsys is used for the colour mapping.
 import colorsys
 
+# numpy is used to store the loaded data.
+import numpy as np
+
+# Pipeline is used to apply the transformations.
+from transforms import Pipeline, resolve_spec
+
+# weighted_statistics is used to calculate the graphed statistics.
+from stats import weighted_statistics
+
+# Fields which are always loaded.
+REQUIRED_FIELDS = (DATE_FIELD, AREA_FIELD, FIELD_NO_FIELD)
+
 
 class Model():
     """ Wrapper class to contain raw data about the models """
     
-    def __init__(self, gis, csv):
+    def __init__(self, gis, csv, use_cache = True, fields = None):
         """ Load the data from the CSV and GIS files, and generate some
             overview information.
+            csv is either a directory of CSV files, or a store file created
+            by export; stores are memory mapped rather than loaded.
+            If use_cache is True, the parsed CSV data is saved next to the
+            CSV directory, and reloaded from there if the files are unchanged.
+            fields is a list of the fields to load up front (in addition to
+            the dates, areas, and field numbers), or None to load every field.
+            Any other fields are loaded the first time they are used.
         """
         
         # Load the data.
@@ -41,53 +64,103 @@ class Model():
         self.size = [(bbox[i + 2] - bbox[i]) for i in range(2)]
         
         # Load the CSV files.
+        # The data is stored as a map from field names to (row, patch) arrays,
+        # with the columns in the same order as patch_numbers. Only some of
+        # the available columns may be loaded; the rest are loaded as
+        # required, under the lock.
         self.csv = csv
-        patch_files = find_patch_files(self.csv)
-        self.data = raw_patches(patch_files)
-        dates = self.extract_field(DATE_FIELD)
-        
-        # Verify the dates, and compress into a row: date mapping.
-        print("Verifying dates...")
-        self.dates = {}
-        for index in dates:
-            date = None
-            for patch in dates[index]:
-                if date == None:
-                    date = dates[index][patch]
-                elif date != dates[index][patch]:
-                    raise ValueError("For some CSV files ({}, index = {}), the dates are not on equal rows!".format(csv, index))
-            self.dates[index] = date
+        self.lock = Lock()
+        self.files = None # The patch files; None for a store.
+        self.cache = None # The cache filename, if we are using one.
+        if os.path.isfile(self.csv):
+            key, self.patch_numbers, self.dates, columns, self.data = \
+                open_store(self.csv)
+            # We have no CSV files to load any missing fields from.
+            self.columns = [field for field in columns if field in self.data]
+        else:
+            self.files = find_patch_files(self.csv)
+            self.key = cache_key(self.files)
+            cached = None
+            if use_cache:
+                self.cache = cache_filename(self.csv)
+                cached = load_cache(self.cache, self.key)
+            if cached != None:
+                self.patch_numbers, self.dates, self.columns, self.data = \
+                    cached
+            else:
+                self.patch_numbers, self.columns, self.data = \
+                    raw_patches(self.files, REQUIRED_FIELDS + \
+                        tuple(fields if fields != None else []), \
+                        fields == None)
+                self.dates = verify_dates(self.extract_field(DATE_FIELD), \
+                    self.csv)
+                self.save_cache()
+            # Load any requested fields missing from the cache.
+            self.load_fields(fields if fields != None else self.columns)
+        # Create a map from patch numbers to columns in the data.
+        self.patch_index = {patch: column \
+            for column, patch in enumerate(self.patch_numbers.tolist())}
 
         print("Finished loading the model")
 
-    # This function is cached, which provides a small speedup. 
-    # TODO: Ideally, I would refactor so this function was never called
-    #       multiple times with the same arguments anyway...
-    @cache
-    def extract_field(self, field, process=lambda v: v):
-        """ Extract a single field from the loaded data, and optionally
-            apply a function 'process' to each piece of data.
+    def load_fields(self, fields):
+        """ Load any of the given fields which are not yet loaded """
+
+        with self.lock:
+            missing = [field for field in fields \
+                if field not in self.data and field in self.columns]
+            if len(missing) == 0:
+                return
+            print("Loading fields {}...".format(", ".join(missing)))
+            patch_numbers, columns, data = raw_patches(self.files, missing)
+            self.data.update(data)
+            self.save_cache()
+
+    def save_cache(self):
+        """ Save the currently loaded data to the cache, if there is one """
+
+        if self.cache != None:
+            save_cache(self.cache, self.key, self.patch_numbers, self.dates, \
+                self.columns, self.data)
+
+    def export(self, filename):
+        """ Export self's CSV data to the given store file.
+            The store can be given in place of the CSV directory; it is memory
+            mapped, so concurrent processes using it share one copy.
         """
-        
-        result = {}
-        for index in self.data:
-            result[index] = {}
-            for patch in self.data[index]:
-                result[index][patch] = \
-                    process(self.data[index][patch][field].strip())
 
-        return result
+        self.load_fields(self.columns)
+        save_store(filename, None, self.patch_numbers, self.dates, \
+            self.columns, self.data)
+
+    def extract_field(self, field):
+        """ Return the given field as a (row, patch) array, loading it if
+            required.
+            The columns are in the same order as self.patch_numbers; the
+            array is shared, so it should not be modified.
+        """
+        
+        if field not in self.columns:
+            raise ValueError("Unknown field {}!".format(field))
+        self.load_fields([field])
+        return self.data[field]
 
     def fields(self):
         """ Return a list of possible fields """
         
-        fields = set()
-        for index in self.data:
-            for patch in self.data[index]:
-                for field in self.data[index][patch].keys():
-                    if field not in fields:
-                        fields.add(field)
-        return fields
+        return set(self.columns)
+
+    def patch_columns(self, patches):
+        """ Return a list of the columns for the given patch numbers """
+        
+        return [self.patch_index[patch] for patch in patches]
+
+    @cache
+    def get_field_numbers(self):
+        """ Return an array of the field number of each patch (column) """
+
+        # There should be at least one row...
+        return self.extract_field(FIELD_NO_FIELD)[0].astype(int)
 
     @cache
     def get_patch_fields(self):
@@ -97,13 +170,12 @@ class Model():
         # TODO: It would be nice if the methodology here could be made more
         #       generic?
 
-        values = self.extract_field(FIELD_NO_FIELD, lambda v: int(float(v)))
         fields = {} # id: [patch_no, ...]
-        # There should be at least one row...
-        for patch in values[0]:
-            if values[0][patch] not in fields:
-                fields[values[0][patch]] = []
-            fields[values[0][patch]].append(patch)
+        for patch, field in zip(self.patch_numbers.tolist(), \
+                self.get_field_numbers().tolist()):
+            if field not in fields:
+                fields[field] = []
+            fields[field].append(patch)
         return fields
 
 
@@ -133,39 +205,111 @@ def find_patch_files(dir):
     
     return patches
 
+def model_key(gis, csv):
+    """ Return a key for the files of the model with the given GIS and CSV
+        files (see Model), which changes whenever any of the files change.
+    """
+
+    gis_files = {ext: gis + ext for ext in ('.shp', '.shx', '.dbf') \
+        if os.path.isfile(gis + ext)}
+    if os.path.isfile(csv):
+        csv_files = {0: csv}
+    else:
+        csv_files = find_patch_files(csv)
+    return [cache_key(gis_files), cache_key(csv_files)]
+
     
-def raw_patches(files):
-    """ Open the given patch files and extract all of the data """
+def verify_dates(dates, dir):
+    """ Verify that the given (row, patch) array of dates is the same for
+        every patch, and return a list of the dates for each row.
+    """
+
+    print("Verifying dates...")
+    unequal = np.nonzero((dates != dates[:, :1]).any(axis=1))[0]
+    if len(unequal) != 0:
+        raise ValueError("For some CSV files ({}, index = {}), the dates are not on equal rows!".format(dir, unequal[0]))
+    return dates[:, 0].tolist()
     
-    # Create the processing group.
-    group = ThreadedGroup()
-    # Create the wrapper function to load a patch file.
-    def load_patch(patch_dict, file_name):
-        # Parse the patch file.
-        with open(file_name) as patch:
-            for index, row in enumerate(csv.DictReader(patch)):
-                # Insert the values into the dict.
-                patch_dict[index] = row
-    # Create the patch dict and load into it.
-    patches = {} # patch: {index: value}
-    for patch_no in files:
-        patches[patch_no] = {}
-        # Start a job loading another patch file.
-        group.start(load_patch, patches[patch_no], files[patch_no])
-    # Wait for the jobs to finish.
-    group.wait()
+def load_patch(file_name, fields = None):
+    """ Load a single patch file, returning the list of fields in the file
+        and a map from field names to columns, for the given fields (or every
+        field, if fields is None).
+        Numeric columns are converted to float arrays; anything else is kept
+        as an array of stripped strings.
+    """
     
-    # Turn the resulting data into a index[patch[value]] format, and strip the
-    # data.
-    result = {} # index: {patch: values}
-    for patch in patches:
-        for index in patches[patch]:
-            if index not in result:
-                result[index] = {}
-            result[index][patch] = {field.strip(): value \
-                for field, value in patches[patch][index].items()}
+    # Parse the patch file.
+    with open(file_name) as patch:
+        reader = csv.reader(patch)
+        header = [field.strip() for field in next(reader)]
+        rows = list(reader)
+    
+    # Transpose the wanted rows into columns, and convert them.
+    columns = {}
+    for index, field in enumerate(header):
+        if fields != None and field not in fields:
+            continue
+        column = [row[index] for row in rows]
+        try:
+            columns[field] = np.array(column, dtype=float)
+        except ValueError:
+            columns[field] = np.char.strip(np.array(column, dtype=str))
+    return header, columns
+
+def stack_patches(patches, names, fields):
+    """ Stack the given fields from a list of patch column maps (as returned
+        by load_patch) into a map from field names to (row, patch) arrays.
+        names is a list of names for the patches, used for error messages.
+    """
+    
+    # Every column must be the same length.
+    rows = None
+    for name, patch in zip(names, patches):
+        for field in fields:
+            if rows == None:
+                rows = len(patch[field])
+            elif rows != len(patch[field]):
+                raise ValueError("Patch {} has {} rows, expected {}!".format( \
+                    name, len(patch[field]), rows))
+
+    data = {}
+    for field in fields:
+        columns = [patch[field] for patch in patches]
+        # If the field is only numeric for some patches, treat it as text.
+        if any((column.dtype.kind != 'f' for column in columns)):
+            columns = [column.astype(str) for column in columns]
+        data[field] = np.column_stack(columns)
+    return data
+    
+def raw_patches(files, fields, all_fields = False):
+    """ Open the given patch files and extract the given fields (or every
+        field, if all_fields is True).
+        This returns an array of the patch numbers, a list of the fields
+        present in every file, and a map from the loaded field names to
+        (row, patch) arrays, with the columns in the same order as the patch
+        numbers.
+    """
+    
+    # Parse the patch files in parallel; each worker process returns the
+    # columns of one file as arrays.
+    patch_numbers = sorted(files.keys())
+    names = [files[patch_no] for patch_no in patch_numbers]
+    patches = process_map(functools.partial(load_patch, \
+        fields = None if all_fields else set(fields)), names)
+    
+    # We only keep the fields which are present for every patch.
+    headers = [set(header) for header, columns in patches]
+    for name, header in zip(names, headers):
+        if header != headers[0]:
+            print("Patch {} has a different set of fields!".format(name))
+    columns = [field for field in patches[0][0] \
+        if all((field in header for header in headers))]
+    
+    # Stack the resulting columns into (row, patch) arrays.
+    data = stack_patches([patch for header, patch in patches], names, \
+        [field for field in columns if field in patches[0][1]])
             
-    return result
+    return np.array(patch_numbers), columns, data
     
 def load_shapes(shape_file):
     """ Generate a list of shapes, and a map from patches to information about
@@ -234,28 +378,26 @@ class Values():
     """ Wrapper class to contain transformed data from a specific model """
     
     def __init__(self, model, field, transforms=()):
-        """ Initialise self """
+        """ Initialise self.
+            transforms is a list of transformations; either specs (see
+            transforms.transformations), or anything accepted by Pipeline.
+        """
         
         self.model = model
         self.transforms = transforms
         
         self.field = field
-        orig_values = self.model.extract_field(self.field, float)
-        # Apply the transformations.
-        self.values = orig_values
-        for transform in transforms:
-            self.values = transform(self.values)
-            
-        # Find the minimum and maximum values.
-        self.min = float("inf")
-        self.max = -float("inf")
-        for index in self.values:
-            for patch in self.values[index]:
-                value = self.values[index][patch]
-                if value < self.min:
-                    self.min = value
-                if value > self.max:
-                    self.max = value
+        orig_values = self.model.extract_field(self.field)
+        if orig_values.dtype.kind != 'f':
+            raise ValueError("Field {} is not numeric!".format(self.field))
+        # Create the (lazy) transformed values; this also finds the minimum
+        # and maximum values.
+        self.values = Pipeline(orig_values, [resolve_spec(transform, model) \
+            if isinstance(transform, tuple) and not callable(transform[0]) \
+            else transform \
+            for transform in transforms])
+        self.min = float(self.values.min)
+        self.max = float(self.values.max)
 
         # We have no domain to start with.
         self.domain = None
@@ -266,83 +408,86 @@ class Graphable():
         not tied to a specific patch.
     """
     
-    def __init__(self, value, label, statistics = ['min', 'mean', 'max']):
-        """ Initialise self """
+    def __init__(self, value, label, statistics = ['min', 'mean', 'max'], \
+            values = None):
+        """ Initialise self.
+            statistics is a list of the statistics to graph; see stats.py for
+            the available statistics.
+            values is an optional (statistic, row) array of the already
+            calculated statistics, as used by group_graphables.
+        """
 
         self.value = value
         self.label = label
+        self.statistics = statistics
         
-        # Get the areas and total area.
-        simple_areas = self.value.model.extract_field(AREA_FIELD, float)
-        self.areas = {} # patch: area
-        self.total_area = 0 # The total area.
+        # Get the areas, which weight each patch.
         # We assume that areas remain the same, so pick the first area.
-        # We also assume that the we only are interested in the patches in the
-        # given values, and that the patches are consistent as time changes,
-        # so we just pick the first one.
-        for patch in value.values[0]:
-            area = int(simple_areas[0][patch])
-            self.areas[patch] = area
-            self.total_area += area
+        self.areas = self.value.model.extract_field(AREA_FIELD)[0]
             
         # Calculate the requested statistics, the minimum, and the maximum.
-        self.calculate_statistics(statistics)
+        self.calculate_statistics(statistics, values)
 
-    def calculate_statistics(self, statistics):
+    def calculate_statistics(self, statistics, values = None):
         """ Calculate self's statistics """
 
-        # Calculate the requested statistics.
-        self.values = []
-        for stat in statistics:
-            if stat == 'mean':
-                def day_func(index):
-                    """ Calculate the weighted mean for the given day """
-                    day = 0
-                    for patch in self.value.values[index]:
-                        day += self.value.values[index][patch] * \
-                            self.areas[patch]
-                    return day / self.total_area
-            elif stat == 'min':
-                day_func = lambda day: min((self.value.values[day][patch] \
-                    for patch in self.value.values[day]))
-            elif stat == 'max':
-                day_func = lambda day: max((self.value.values[day][patch] \
-                    for patch in self.value.values[day]))
-            elif stat == 'sum':
-                def day_func(index):
-                    """ Calculate the weighted sum for the given day """
-                    day = 0
-                    for patch in self.value.values[index]:
-                        day += self.value.values[index][patch] * \
-                            self.areas[patch]
-                    return day
-            else:
-                raise ValueError("Unknown statistic {}!".format(stat))
-            self.values.append({day: day_func(day) \
-                for day in self.value.values})
+        # Calculate every requested statistic in one pass through the values.
+        # self.values is a (statistic, row) array.
+        if values is None:
+            values = weighted_statistics(self.value.values.chunks(), \
+                self.areas, statistics)
+        self.values = values
                 
         # Calculate the maximums and minimums.
-        self.max = max([max(stat_values.values()) \
-            for stat_values in self.values])
-        self.min = min([min(stat_values.values()) \
-            for stat_values in self.values])
+        self.max = float(np.nanmax(self.values))
+        self.min = float(np.nanmin(self.values))
         
     def __getitem__(self, date):
         """ Returns self's value on the given date.
             If it is a tuple, then it represents a range of values.
         """
         
-        return [stat[date] for stat in self.values]
+        return [float(value) for value in self.values[:, date]]
+
+
+def group_graphables(value, groups, statistics = ['min', 'mean', 'max'], \
+        label = "{}"):
+    """ Return a list of Graphables for the given Values, one for each group.
+        groups maps group names to lists of patch numbers, such as
+        Model.get_patch_fields(); patches not in any group are ignored.
+        label is formatted with each group's name to give the graph labels.
+        Every group's statistics are calculated together in one pass through
+        the values, so the cost does not depend on the number of groups.
+    """
+
+    model = value.model
+    names = list(groups.keys())
+    # Find the group index of each column.
+    column_groups = np.full(len(model.patch_numbers), -1, dtype=int)
+    for index, name in enumerate(names):
+        column_groups[model.patch_columns(groups[name])] = index
+    # Calculate the statistics.
+    areas = model.extract_field(AREA_FIELD)[0]
+    results = weighted_statistics(value.values.chunks(), areas, statistics, \
+        column_groups)
+    return [Graphable(value, label.format(name), statistics, \
+            values = results[:, :, index]) \
+        for index, name in enumerate(names)]
 
 
 class Graph():
     """ A list of graphables with additional information on the domain """
 
-    def __init__(self, graphables, label = DEFAULT_LABEL):
-        """ Initialise self """
+    def __init__(self, graphables, label = DEFAULT_LABEL, envelope = False):
+        """ Initialise self.
+            If envelope is True, the graphables are shown as a shaded band
+            from their minimum to their maximum for each statistic, rather
+            than as individual lines; this suits many similar graphables.
+        """
 
         # Save the graphables.
         self.graphables = graphables
+        self.envelope = envelope
 
         # Save the label.
         self.label = label
@@ -373,26 +518,49 @@ class Domain():
         for obj in objects:
             obj.domain = self
         
-        # Generate a value2colour function if a colour range is supplied.
+        # Generate the colour conversion functions if a colour range is
+        # supplied.
         self.value2colour = None
+        self.values2colours = None
         if colour_range != None:
-            def value2colour(value):
-                """ Convert from a given value to a colour, using the basic
+            def hue2colour(hue):
+                """ Convert from a hue (0 to 1) to a colour, using the basic
                     algorithm described at:
                     http://stackoverflow.com/questions/10901085/range-values-to-pseudocolor/10907855#01907855
                 """
-                # We scale to a specific colour range (in HSV, 0 to 1).
-                try:
-                    hue = ((value - self.min) / (self.max - self.min))
-                except ZeroDivisionError:
-                    hue = 0
                 # Convert the hue into something in the given range.
                 value = hue * (colour_range[1] - colour_range[0]) + \
                     colour_range[0]
                 # Return a RGB version of that colour.
                 return [int(i*255) for i in colorsys.hsv_to_rgb(value, 1, 1)]
 
-            self.value2colour = value2colour
+            # Precalculate a table of colours from the minimum to the maximum,
+            # with BROKEN_COLOUR (for missing values) at the end.
+            self.colour_table = np.array([hue2colour(float(i) / \
+                    (COLOUR_TABLE_SIZE - 1)) \
+                for i in range(COLOUR_TABLE_SIZE)] + [BROKEN_COLOUR], \
+                dtype=np.uint8)
+
+            def values2colours(values):
+                """ Convert from an array of values to an array of colours,
+                    with an extra last axis for the RGB components.
+                """
+                # We scale to a specific colour range (0 to 1), and then find
+                # the closest colour in the table.
+                values = np.asarray(values, dtype=float)
+                if self.max > self.min:
+                    hue = (values - self.min) / (self.max - self.min)
+                else:
+                    hue = np.zeros(values.shape)
+                indexes = np.clip(np.rint(hue * (COLOUR_TABLE_SIZE - 1)), \
+                    0, COLOUR_TABLE_SIZE - 1)
+                indexes = np.where(np.isnan(values), COLOUR_TABLE_SIZE, indexes)
+                return self.colour_table[indexes.astype(int)]
 
+            def value2colour(value):
+                """ Convert from a given value to a colour """
+                return values2colours(value).tolist()
 
+            self.value2colour = value2colour
+            self.values2colours = values2colours
 
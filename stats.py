@@ -0,0 +1,192 @@
+""" A small library of vectorised, weighted statistics functions.
+
+    Author: Alastair Hughes
+"""
+
+import re
+import numpy as np
+
+# Statistics functions:
+# These are calculated for each row of a (row index, patch) array 'values',
+# with each patch weighted by the matching element of 'weights' (typically the
+# patch areas). Patches are optionally split into groups (typically fields);
+# 'groups' then gives the group index for each column, with columns in a
+# negative group ignored. Missing (NaN) values are ignored; a group without
+# any values has a NaN statistic.
+# Supported statistics are 'min', 'max', 'sum' (the weighted sum), 'mean',
+# 'std' (the weighted standard deviation), 'median', and percentiles, given as
+# 'p' and a number between 0 and 100 ('p10', 'p90', 'p2.5').
+
+# Percentile statistics.
+PERCENTILE_RE = re.compile(r"^p([0-9]+(\.[0-9]*)?)$")
+
+def percentile(stat):
+    """ Return the percentile for the given statistic, or None if it is not a
+        percentile.
+    """
+    if stat == 'median':
+        return 50.0
+    match = PERCENTILE_RE.match(stat)
+    if match != None and float(match.group(1)) <= 100:
+        return float(match.group(1))
+    return None
+
+def check_statistics(statistics):
+    """ Raise a ValueError if any of the given statistics is unknown """
+    for stat in statistics:
+        if stat not in ('min', 'max', 'sum', 'mean', 'std') and \
+                percentile(stat) == None:
+            raise ValueError("Unknown statistic {}!".format(stat))
+
+
+class Grouping():
+    """ The column ordering and group boundaries shared by every chunk """
+
+    def __init__(self, weights, groups = None):
+        """ Initialise self """
+
+        weights = np.asarray(weights, dtype=float)
+        if groups is None:
+            groups = np.zeros(len(weights), dtype=int)
+        groups = np.asarray(groups)
+        # The number of groups; empty groups are allowed.
+        self.count = int(groups.max()) + 1 if len(groups) > 0 else 0
+        # Sort the used columns by group, so that every group is a contiguous
+        # run of columns that ufunc.reduceat can reduce over.
+        used = np.flatnonzero(groups >= 0)
+        self.order = used[np.argsort(groups[used], kind='mergesort')]
+        self.groups = groups[self.order]
+        self.weights = weights[self.order]
+        # The start of each non-empty group, and the matching group indexes.
+        sizes = np.bincount(self.groups, minlength=self.count)
+        self.present = np.flatnonzero(sizes)
+        self.starts = (np.cumsum(sizes) - sizes)[self.present]
+        # The (non-empty) group index of each sorted column.
+        self.column_groups = np.repeat(np.arange(len(self.present)), \
+            sizes[self.present])
+
+    def reduce(self, ufunc, values):
+        """ Reduce each group of the given (sorted) columns with ufunc,
+            returning a (row, group) array.
+        """
+        result = np.full((values.shape[0], self.count), np.nan)
+        if len(self.present) > 0:
+            result[:, self.present] = ufunc.reduceat(values, self.starts, \
+                axis=1)
+        return result
+
+    def spread(self, values):
+        """ Spread a (row, group) array back out over the sorted columns """
+        return values[:, self.present][:, self.column_groups]
+
+    def statistics(self, values, statistics):
+        """ Return a (statistic, row, group) array with the given statistics
+            for the given (row, patch) array.
+        """
+
+        values = np.asarray(values, dtype=float)[:, self.order]
+        missing = np.isnan(values)
+        # The weight of every value, with missing values not counted.
+        weights = np.where(missing, 0, self.weights)
+        weighted = np.where(missing, 0, values) * weights
+        with np.errstate(invalid='ignore', divide='ignore'):
+            total = self.reduce(np.add, weights)
+            mean = self.reduce(np.add, weighted) / total
+
+        # Sort each group's values once, for any percentiles.
+        ranked = None
+        if any(percentile(stat) != None for stat in statistics):
+            ranked = self.rank(values, missing)
+
+        results = np.empty((len(statistics), values.shape[0], self.count))
+        for index, stat in enumerate(statistics):
+            if stat == 'min':
+                results[index] = self.reduce(np.fmin, values)
+            elif stat == 'max':
+                results[index] = self.reduce(np.fmax, values)
+            elif stat == 'sum':
+                results[index] = self.reduce(np.add, weighted)
+                results[index][total == 0] = np.nan
+            elif stat == 'mean':
+                results[index] = mean
+            elif stat == 'std':
+                deviation = np.where(missing, 0, \
+                    values - self.spread(mean)) ** 2
+                with np.errstate(invalid='ignore'):
+                    results[index] = np.sqrt( \
+                        self.reduce(np.add, deviation * weights) / total)
+            elif percentile(stat) != None:
+                results[index] = self.percentile(ranked, percentile(stat))
+            else:
+                raise ValueError("Unknown statistic {}!".format(stat))
+        return results
+
+    def rank(self, values, missing):
+        """ Sort the values within each group, returning the sorted values,
+            the cumulative weight within each group, each group's total
+            weight, and the number of values in each group, all by column.
+        """
+
+        # Sort by group then value; missing values sort to the end of their
+        # group.
+        groups = np.broadcast_to(self.groups, values.shape)
+        order = np.lexsort((values, groups), axis=1)
+        rows = np.arange(values.shape[0])[:, None]
+        values = values[rows, order]
+        weights = np.where(missing, 0, self.weights)[rows, order]
+        # Find the cumulative weight from the start of each group.
+        culm = np.cumsum(weights, axis=1)
+        culm -= self.spread(self.starts_culm(culm, weights))
+        total = self.spread(self.reduce(np.add, weights))
+        # Empty groups have no values, rather than a NaN count.
+        count = np.nan_to_num(self.reduce(np.add, (~missing).astype(int)))
+        return values, culm, total, count
+
+    def starts_culm(self, culm, weights):
+        """ Return the cumulative weight before the start of each group """
+        before = np.zeros((culm.shape[0], self.count))
+        before[:, self.present] = culm[:, self.starts] - \
+            weights[:, self.starts]
+        return before
+
+    def percentile(self, ranked, q):
+        """ Return the weighted q'th percentile (0 to 100) of each group.
+            This is the smallest value with at least q percent of the group's
+            weight at or below it.
+        """
+
+        values, culm, total, count = ranked
+        # Count the values in each group below the target weight; the next
+        # value is the percentile.
+        below = culm < (total * (q / 100.0))
+        index = self.reduce(np.add, below.astype(int))
+        # Ignore missing values, which are at the end of each group.
+        index = np.minimum(index, count - 1)
+        result = np.full(index.shape, np.nan)
+        valid = count > 0
+        offsets = np.zeros(self.count, dtype=int)
+        offsets[self.present] = self.starts
+        rows, groups = np.nonzero(valid)
+        result[rows, groups] = values[rows, \
+            offsets[groups] + index[rows, groups].astype(int)]
+        return result
+
+
+def weighted_statistics(chunks, weights, statistics, groups = None):
+    """ Calculate the given statistics for every row of an array given as an
+        iterable of (start row, rows) chunks, such as Pipeline.chunks().
+        Returns a (statistic, row, group) array, or a (statistic, row) array
+        if groups is None.
+    """
+
+    check_statistics(statistics)
+    grouping = Grouping(weights, groups)
+    results = [grouping.statistics(rows, statistics) \
+        for start, rows in chunks]
+    if len(results) == 0:
+        results = np.empty((len(statistics), 0, grouping.count))
+    else:
+        results = np.concatenate(results, axis=1)
+    if groups is None:
+        return results[:, :, 0]
+    return results
@@ -0,0 +1,184 @@
+""" Functions to save and load parsed model data to and from disk.
+
+    Parsing a large directory of CSV files is slow, so we save the parsed
+    arrays to a 'store' file, and reload them from there when none of the CSV
+    files have changed. Stores can also be exported explicitly and opened in
+    place of a CSV directory.
+
+    A store is a single file, containing a short JSON header describing the
+    arrays followed by the raw arrays themselves. Opened stores are memory
+    mapped, so the data is only paged in as it is used, and processes opening
+    the same store share a single copy of it through the OS page cache.
+    Windows cannot replace a mapped file, so caches are copied into memory
+    there instead, allowing them to be rewritten as more fields are loaded.
+
+    Author: Alastair Hughes
+"""
+
+from constants import CACHE_SUFFIX, STORE_VERSION
+
+import json
+import os, os.path
+import struct
+import numpy as np
+
+# Store format details.
+MAGIC = b"IRRSTORE" # Magic string at the start of every store.
+ALIGNMENT = 64 # Alignment of the arrays within the store, in bytes.
+
+
+def cache_filename(dir):
+    """ Return the filename of the cache for the given CSV directory """
+    return os.path.normpath(dir) + CACHE_SUFFIX
+
+def cache_key(files):
+    """ Generate a key for the given patch files (a map from patch numbers
+        to filenames), which changes whenever any of the files change.
+    """
+
+    key = []
+    for patch_no in sorted(files):
+        stat = os.stat(files[patch_no])
+        key.append([patch_no, os.path.basename(files[patch_no]), \
+            stat.st_size, stat.st_mtime])
+    return json.dumps(key)
+
+def load_cache(filename, key):
+    """ Open the given cache file, returning the patch numbers, dates,
+        columns, and data (as for open_store).
+        Returns None if the cache does not exist, is unreadable, or does not
+        match the given key.
+    """
+
+    if not os.path.exists(filename):
+        return None
+
+    try:
+        # Windows cannot replace a file while it is mapped, so the cache is
+        # copied into memory there; otherwise, it could never be rewritten
+        # with any fields loaded later (see save_cache).
+        cache_key, patch_numbers, dates, columns, data = \
+            open_store(filename, copy = os.name == 'nt')
+    except (IOError, OSError, ValueError, KeyError) as e:
+        print("Ignoring unreadable cache {} ({})".format(filename, e))
+        return None
+    if cache_key != key:
+        print("Cache {} is out of date".format(filename))
+        return None
+
+    print("Loaded cached data from {}".format(filename))
+    return patch_numbers, dates, columns, data
+
+def save_cache(filename, key, patch_numbers, dates, columns, data):
+    """ Save the given patch numbers, dates, columns, and data to a cache
+        file.
+        Failing to write the cache is not fatal, so we just print a warning.
+    """
+
+    # Write to a temporary file and then move it into place, so that an
+    # interrupted write never leaves a partial cache behind.
+    # The temporary file is per-process, as other processes may be loading
+    # the same files at once.
+    temp = filename + ".{}.tmp".format(os.getpid())
+    try:
+        save_store(temp, key, patch_numbers, dates, columns, data)
+        replace(temp, filename)
+    except (IOError, OSError) as e:
+        print("WARNING: Failed to write the cache {} ({})".format(filename, e))
+        # Don't leave the (possibly large) temporary file behind.
+        if os.path.exists(temp):
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+
+def save_store(filename, key, patch_numbers, dates, columns, data):
+    """ Save the patch numbers, a list of dates, a list of all of the
+        columns, and a map from the loaded field names to (row, patch) arrays
+        into the given store file.
+        key is saved in the header, and returned by open_store.
+    """
+
+    # Generate the list of arrays to save, and their header entries.
+    arrays = [] # [array, ...]
+    def add(array):
+        """ Add the given array, returning the header entry describing it """
+        array = np.ascontiguousarray(array)
+        offset = sum((aligned(saved.nbytes) for saved in arrays))
+        arrays.append(array)
+        return {'dtype': array.dtype.str, 'shape': list(array.shape), \
+            'offset': offset}
+    header = {'version': STORE_VERSION, 'key': key, 'columns': columns}
+    header['patch_numbers'] = add(patch_numbers)
+    header['dates'] = add(np.array(dates, dtype=str))
+    header['fields'] = {field: add(data[field]) for field in sorted(data)}
+    header = json.dumps(header).encode('utf-8')
+
+    with open(filename, 'wb') as store:
+        store.write(MAGIC)
+        store.write(struct.pack('<Q', len(header)))
+        store.write(header)
+        pad(store)
+        for array in arrays:
+            store.write(array.tobytes())
+            pad(store)
+
+def open_store(filename, copy = False):
+    """ Open the given store file, returning the key, patch numbers, list of
+        dates, list of columns, and a map from the saved field names to
+        (row, patch) arrays.
+        The arrays are read-only views of a memory mapping of the file, or
+        read-only copies of the arrays if copy is True, in which case the
+        file is not kept open.
+    """
+
+    with open(filename, 'rb') as store:
+        if store.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a model store!".format(filename))
+        length = struct.unpack('<Q', store.read(8))[0]
+        header = json.loads(store.read(length).decode('utf-8'))
+    if header['version'] != STORE_VERSION:
+        raise ValueError("{} has an unsupported version ({})!".format( \
+            filename, header['version']))
+
+    # Map the whole file once; the arrays are views into it.
+    mapping = np.memmap(filename, dtype=np.uint8, mode='r')
+    start = aligned(len(MAGIC) + 8 + length)
+    def view(entry):
+        """ Return the array described by the given entry """
+        dtype = np.dtype(str(entry['dtype']))
+        shape = tuple(entry['shape'])
+        offset = start + entry['offset']
+        size = dtype.itemsize * int(np.prod(shape))
+        if offset + size > len(mapping):
+            raise ValueError("{} is truncated!".format(filename))
+        array = mapping[offset:offset + size].view(dtype).reshape(shape)
+        if copy:
+            array = np.array(array)
+            array.flags.writeable = False
+        return array
+
+    patch_numbers = view(header['patch_numbers'])
+    dates = view(header['dates']).tolist()
+    data = {str(field): view(entry) \
+        for field, entry in header['fields'].items()}
+    columns = [str(field) for field in header['columns']]
+    return header['key'], patch_numbers, dates, columns, data
+
+def aligned(size):
+    """ Round the given size up to a multiple of ALIGNMENT """
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+def pad(store):
+    """ Pad the given file to a multiple of ALIGNMENT """
+    store.write(b'\0' * (aligned(store.tell()) - store.tell()))
+
+def replace(source, dest):
+    """ Move source to dest, replacing dest if it exists """
+
+    try:
+        os.rename(source, dest)
+    except OSError:
+        # On Windows, rename will not replace an existing file.
+        os.remove(dest)
+        os.rename(source, dest)
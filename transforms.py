@@ -3,109 +3,331 @@
     Author: Alastair Hughes
 """
 
-from constants import MAX_FRAMES_PER_DAY, MIN_FRAMES_PER_DAY
+from constants import CACHED_CHUNKS, CHUNK_ROWS, MAX_FRAMES_PER_DAY, \
+    MIN_FRAMES_PER_DAY
+from collections import OrderedDict
+from threading import Lock
 import math
+import numpy as np
 
 # Transformation functions:
-# These accept a map 'values' of the form values[row index][patch no], and
-# returns another map 'values' suitably transformed.
+# These accept a (row index, patch) array 'values', with the columns in the
+# same order as the model's patch numbers, and return another array suitably
+# transformed. Patches without a value (for instance, those removed by
+# patch_filter) are NaN.
 # These are applied to the data as preprocessing. For instance,
 # time_delta_value returns the delta between the current and previous value.
 
 # Time delta uses the delta between a value and the previous day's result.
 def time_delta_value(values):
-    new_values = {}
-    for index in values:
-        new_values[index] = {}
-        for patch in values[index]:
-            new_values[index][patch] = values[index][patch] - \
-                values.get(index - 1, {patch: values[index][patch]})[patch]
+    new_values = np.empty(values.shape)
+    new_values[0] = 0
+    new_values[1:] = np.diff(values, axis=0)
+    # Keep missing values missing.
+    new_values[0][np.isnan(values[0])] = np.nan
     return new_values
 
 # Time culm acculumates the value for a specific patch as time goes on.
 def time_culm_value(values):
-    new_values = {}
-    for index in sorted(values.keys()):
-        new_values[index] = {}
-        for patch in values[index]:
-            new_values[index][patch] = values[index][patch] + \
-                new_values.get(index - 1, {patch: 0})[patch]
-    return new_values
+    return np.cumsum(values, axis=0)
 
 # Field delta uses the relative delta between a value and the maximum and
 # minimums on one specific day.
 def field_delta_value(values):
-    new_values = {}
-    for index in values:
-        new_values[index] = {}
-        min_day = min(values[index].values())
-        max_day = max(values[index].values())
-        for patch in values[index]:
-            try:
-                new_values[index][patch] = \
-                    ((values[index][patch] - min_day) / (max_day - min_day))
-            except ZeroDivisionError:
-                new_values[index][patch] = 0
-    return new_values
+    min_day = np.fmin.reduce(values, axis=1, keepdims=True)
+    max_day = np.fmax.reduce(values, axis=1, keepdims=True)
+    return normalise(values, min_day, max_day)
 
 # Per field normalises the data relative to specific fields.
 def per_field_value(values, fields):
     """ This normalises all patches relative to their field.
-        'fields' is a map of field numbers to a list of patches in that field.
+        'fields' is an array of the field number of each patch (column).
     """
 
-    field_list = list(fields.values())
-
-    # We calculate the maximum and minimum values for each field.
-    maxs = [max((values[index][patch] for index in values \
-                for patch in field)) for field in field_list]
-    mins = [min((values[index][patch] for index in values \
-                for patch in field)) for field in field_list]
-
-    new_values = {}
-    for field_id, field in enumerate(field_list):
-        f_max = maxs[field_id]
-        f_min = mins[field_id]
-        for index in values:
-            if index not in new_values:
-                new_values[index] = {}
-            for patch in field:
-                try:
-                    scaled_value = float(values[index][patch] - f_min) / \
-                        (f_max - f_min)
-                except ZeroDivisionError:
-                    scaled_value = 0
-                new_values[index][patch] = scaled_value
-
-    return new_values
+    mins, maxs = field_limits(np.fmin.reduce(values, axis=0), \
+        np.fmax.reduce(values, axis=0), fields)
+    return normalise(values, mins, maxs)
 
 # Exponential scaling.
 def exponential_value(values, v = math.e):
-    new_values = {}
-    for index in values:
-        new_values[index] = {}
-        for patch in values[index]:
-            new_values[index][patch] = v**(values[index][patch])
-    return new_values
+    return np.power(v, values)
 
 # Logarithmic scaling.
 def log_value(values, v = math.e):
-    new_values = {}
-    for index in values:
-        new_values[index] = {}
-        for patch in values[index]:
-            new_values[index][patch] = math.log(values[index][patch], v)
-    return new_values
+    if (values <= 0).any():
+        raise ValueError("math domain error")
+    return np.log(values) / math.log(v)
 
-# Filter by patch_no.
+# Filter by patch column.
 def patch_filter(values, patches):
-    new_values = {}
-    for index in values:
-        new_values[index] = {}
-        for patch in patches:
-            new_values[index][patch] = values[index][patch]
+    """ Remove all but the given patches (a list of columns) """
+    new_values = np.full(values.shape, np.nan)
+    new_values[:, patches] = values[:, patches]
     return new_values
 
+def field_limits(mins, maxs, fields):
+    """ Given the minimum and maximum of each patch (column), return the
+        minimum and maximum of the field containing each patch.
+    """
+    
+    # Find the field index of each column.
+    field_list, field_index = np.unique(fields, return_inverse=True)
+
+    # Reduce the limits for each field.
+    field_maxs = np.full(len(field_list), np.nan)
+    np.fmax.at(field_maxs, field_index, maxs)
+    field_mins = np.full(len(field_list), np.nan)
+    np.fmin.at(field_mins, field_index, mins)
+
+    return field_mins[field_index], field_maxs[field_index]
+
+def normalise(values, mins, maxs):
+    """ Scale the given values to between 0 and 1, relative to the given
+        (broadcastable) minimums and maximums.
+        Values with an equal minimum and maximum are scaled to 0.
+    """
+    
+    ranges = maxs - mins
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scaled = (values - mins) / ranges
+    return np.where((ranges == 0) & ~np.isnan(values), 0, scaled)
+
+
+# Named transformations.
+# These allow transformations to be described by hashable 'specs'; a spec is
+# a tuple of a name and any extra arguments, such as ('per_field',) or
+# ('patch_filter', (patch_no, ...)).
+# Format: {name: [func, arg1, ...]}
+# Arguments are optional, and are special strings, for arguments generated
+# from the model and passed before the spec's own arguments:
+# - 'fields' is the field number of each patch.
+# - 'patches' replaces the spec's first argument, a list of patch numbers,
+#   with the corresponding list of columns.
+transformations = {
+    'field_delta': [field_delta_value],
+    'time_delta': [time_delta_value],
+    'time_culm': [time_culm_value],
+    'exponential': [exponential_value],
+    'log': [log_value],
+    'per_field': [per_field_value, 'fields'],
+    'patch_filter': [patch_filter, 'patches'],
+}
+
+def resolve_spec(spec, model):
+    """ Convert the given spec into a (function, args...) tuple for the given
+        model, as expected by Pipeline.
+    """
+
+    func = transformations[spec[0]][0]
+    args = list(spec[1:])
+    for arg in reversed(transformations[spec[0]][1:]):
+        if arg == 'fields':
+            args.insert(0, model.get_field_numbers())
+        elif arg == 'patches':
+            args[0] = model.patch_columns(args[0])
+        else:
+            raise ValueError("Unknown transform arg {}!".format(arg))
+    return tuple([func] + args)
+
+
+# Lazy transformation pipelines:
+# Rather than applying each transformation to the whole array in turn, a
+# Pipeline applies all of them to one chunk of rows at a time, and only when
+# those rows are requested. Each transformation becomes a 'stage', which acts
+# as the source of rows for the next stage.
+class ArrayStage():
+    """ The initial stage, returning rows from an array """
+
+    def __init__(self, values):
+        """ Initialise self """
+        self.values = values
+        self.shape = values.shape
+
+    def rows(self, start, stop):
+        """ Return the rows in [start, stop) """
+        return self.values[start:stop]
+
+    def chunks(self):
+        """ Iterate through (start, rows) chunks of all of self's rows """
+        for start in range(0, self.shape[0], CHUNK_ROWS):
+            yield start, self.rows(start, min(start + CHUNK_ROWS, \
+                self.shape[0]))
+
+
+class RowStage(ArrayStage):
+    """ A stage for transformations that treat each row independently """
+
+    def __init__(self, source, func, *args):
+        """ Initialise self """
+        self.source = source
+        self.shape = source.shape
+        self.func = func
+        self.args = args
+
+    def rows(self, start, stop):
+        """ Return the rows in [start, stop) """
+        return self.func(self.source.rows(start, stop), *self.args)
+
+
+class TimeDeltaStage(RowStage):
+    """ A stage for time_delta_value, which also needs the previous row """
+
+    def rows(self, start, stop):
+        """ Return the rows in [start, stop) """
+        if start == 0:
+            return time_delta_value(self.source.rows(start, stop))
+        return np.diff(self.source.rows(start - 1, stop), axis=0)
+
+
+class TimeCulmStage(RowStage):
+    """ A stage for time_culm_value, which remembers the running total at the
+        start of each chunk.
+    """
+
+    def __init__(self, source):
+        """ Initialise self """
+        RowStage.__init__(self, source, time_culm_value)
+        self.totals = [] # The total of all rows before each chunk.
+        total = np.zeros(self.shape[1:])
+        for start, rows in source.chunks():
+            self.totals.append(total)
+            total = total + rows.sum(axis=0)
+
+    def rows(self, start, stop):
+        """ Return the rows in [start, stop) """
+        chunk = start // CHUNK_ROWS
+        chunk_start = chunk * CHUNK_ROWS
+        rows = self.source.rows(chunk_start, stop)
+        return (self.totals[chunk] + np.cumsum(rows, axis=0)) \
+            [start - chunk_start:]
+
+
+class PerFieldStage(RowStage):
+    """ A stage for per_field_value, which needs the field limits first """
+
+    def __init__(self, source, fields):
+        """ Initialise self """
+        RowStage.__init__(self, source, normalise)
+        mins = np.full(self.shape[1:], np.nan)
+        maxs = np.full(self.shape[1:], np.nan)
+        for start, rows in source.chunks():
+            mins = np.fmin(mins, np.fmin.reduce(rows, axis=0))
+            maxs = np.fmax(maxs, np.fmax.reduce(rows, axis=0))
+        self.args = field_limits(mins, maxs, fields)
+
+
+class EagerStage(RowStage):
+    """ A stage for any other transformation function, which is applied to
+        the whole array at once.
+    """
+
+    def __init__(self, source, func):
+        """ Initialise self """
+        RowStage.__init__(self, source, func)
+        self.values = func(source.rows(0, self.shape[0]))
+        self.shape = self.values.shape
+
+    def rows(self, start, stop):
+        """ Return the rows in [start, stop) """
+        return self.values[start:stop]
+
+
+# Map from transformation functions to the stages implementing them.
+stages = {time_delta_value: lambda source: \
+        TimeDeltaStage(source, time_delta_value),
+    time_culm_value: TimeCulmStage,
+    field_delta_value: lambda source: RowStage(source, field_delta_value),
+    per_field_value: PerFieldStage,
+    exponential_value: lambda source, *args: \
+        RowStage(source, exponential_value, *args),
+    log_value: lambda source, *args: RowStage(source, log_value, *args),
+    patch_filter: lambda source, patches: \
+        RowStage(source, patch_filter, patches)}
+
+
+class Pipeline():
+    """ A lazily transformed (row index, patch) array.
+        Rows are only transformed when requested, one chunk at a time, and a
+        few recently used chunks are cached.
+    """
+
+    def __init__(self, values, transforms = ()):
+        """ Initialise self.
+            transforms is a list of transformations, each of which is either
+            a tuple of a transformation function and any extra arguments, or
+            a function accepting and returning a whole array.
+        """
+
+        # Create the stages.
+        self.stage = ArrayStage(values)
+        for transform in transforms:
+            if callable(transform):
+                self.stage = EagerStage(self.stage, transform)
+            else:
+                self.stage = stages[transform[0]](self.stage, *transform[1:])
+        self.shape = self.stage.shape
+
+        # Cache for the recently transformed chunks (chunk: rows).
+        self.cache = OrderedDict()
+        self.lock = Lock()
+        
+        # Find the minimum and maximum values, in one pass.
+        self.min = np.nan
+        self.max = np.nan
+        for start, rows in self.chunks():
+            self.min = np.fmin(self.min, np.fmin.reduce(rows, axis=None))
+            self.max = np.fmax(self.max, np.fmax.reduce(rows, axis=None))
+
+    def chunk(self, chunk):
+        """ Return the rows in the given chunk """
+
+        with self.lock:
+            if chunk in self.cache:
+                rows = self.cache.pop(chunk)
+            else:
+                start = chunk * CHUNK_ROWS
+                rows = self.stage.rows(start, min(start + CHUNK_ROWS, \
+                    self.shape[0]))
+                if len(self.cache) >= CACHED_CHUNKS:
+                    self.cache.popitem(last = False)
+            # (Re)insert the chunk as the most recently used.
+            self.cache[chunk] = rows
+            return rows
+
+    def chunks(self):
+        """ Iterate through (start, rows) chunks of all of self's rows """
+        for chunk in range(-(-self.shape[0] // CHUNK_ROWS)):
+            yield chunk * CHUNK_ROWS, self.chunk(chunk)
+
+    def array(self):
+        """ Return all of self's rows as an array """
+        return self[0:len(self)]
+
+    def __len__(self):
+        """ Return the number of rows """
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        """ Return the given row, or slice of rows """
+
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("Stepped slices are not supported!")
+            rows = [self.chunk(chunk)[max(start - chunk * CHUNK_ROWS, 0): \
+                    stop - chunk * CHUNK_ROWS] \
+                for chunk in range(start // CHUNK_ROWS, \
+                    -(-stop // CHUNK_ROWS))]
+            if len(rows) == 0:
+                return np.empty((0,) + self.shape[1:])
+            return np.concatenate(rows)
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Row {} out of range!".format(index))
+        return self.chunk(index // CHUNK_ROWS)[index % CHUNK_ROWS]
+
 
 # Time mapping functions:
 # Basic time map functions; these are functions that accept a list of Values
@@ -119,7 +341,7 @@ def map_basic(values):
             one_value = value
         elif one_value.model.dates != value.model.dates:
             raise ValueError("All models must have the same set of dates!")
-    return {i: i for i in one_value.model.dates}
+    return {i: i for i in range(len(one_value.model.dates))}
     
 def map_delta(values):
     """ Map from frames to dates, with the frame count per date largely
@@ -130,43 +352,31 @@ def map_delta(values):
     # Validate the values.
     dates = map_basic(values)
     
-    def max_day(v, date):
-        """ Return the max value for a given date.
-            If the given date does not exist, return the max delta for
-            the date +1 in the future.
-        """
-        if date not in v.values:
-            date += 1
-        return max((abs(v.values[date][patch]) \
-            for patch in v.values[date]))
-    
-    # Generate a map of maximum deltas per day.
-    max_deltas = {}
-    for date in dates:
-        max_deltas[date] = max((abs(max_day(v, date) - max_day(v, date - 1)) \
-            for v in values))
+    # Generate an array of maximum deltas per day; this is the largest change
+    # in any of the values' maximum absolute value from the previous day.
+    max_deltas = np.zeros(len(dates))
+    for v in values:
+        max_day = np.concatenate([np.fmax.reduce(np.abs(rows), axis=1) \
+            for start, rows in v.values.chunks()])
+        delta = np.abs(np.diff(max_day))
+        max_deltas[1:] = np.fmax(max_deltas[1:], delta)
         
     # Find the minimum and maximum deltas (positive values only!)
-    max_delta = abs(max(max_deltas.values()))
-    min_delta = abs(min(max_deltas.values()))
+    max_delta = max_deltas.max()
+    min_delta = max_deltas.min()
     
-    frames = {}
-    cur_frame = 0
-    # We assume that dates can be sorted sensibly.
-    # Iterate through the dates, adding them and increasing the number of
+    # Find the number of frames for each date, increasing the number of
     # frames for days with large deltas.
-    for date in sorted(dates.values()):
-        try:
-            relative_delta = (max_deltas[date]-min_delta) / (max_delta-min_delta)
-        except ZeroDivisionError:
-            relative_delta = 0
-        frame_count = int((MAX_FRAMES_PER_DAY - MIN_FRAMES_PER_DAY) \
-            * relative_delta + MIN_FRAMES_PER_DAY)
-        for i in range(frame_count):
-            frames[cur_frame] = date
-            cur_frame += 1
-            
-    return frames
+    if max_delta != min_delta:
+        relative_delta = (max_deltas - min_delta) / (max_delta - min_delta)
+    else:
+        relative_delta = np.zeros(len(dates))
+    frame_counts = ((MAX_FRAMES_PER_DAY - MIN_FRAMES_PER_DAY) \
+        * relative_delta + MIN_FRAMES_PER_DAY).astype(int)
+    
+    # We assume that dates can be sorted sensibly.
+    frame_dates = np.repeat(sorted(dates.values()), frame_counts)
+    return {frame: date for frame, date in enumerate(frame_dates.tolist())}
     
 # Map from time warp type to the actual function.
 times = {'basic': map_basic,
@@ -13,17 +13,25 @@
     The function given to render is assumed to accept the size of the rendered
     image, and the surface being rendered onto. It will return an offset from
     the top-left corner of the surface to render the top-left corner at.
+
+    Widgets which render differently at different times are 'dynamic'; others
+    can be rendered once and reused. Dynamic widgets may also be split into
+    render_static and render_dynamic functions (accepting the same arguments
+    as render, but without a time for render_static), so that the static part
+    can be reused.
     
     Author: Alastair Hughes
 """
 
-from constants import ANCHOR_FORCE, BROKEN_COLOUR, EDGE_COLOUR, \
-    EDGE_THICKNESS, GRAPH_ALPHA, GRAPH_COLOUR_LIST, ITERATION_MULTIPLIER, \
-    PLACEMENT_CONSTANT, OVERLAP_FORCE, SCALE_MARKER_SIZE, SCALE_SPACING, \
-    SCALE_TEXT_OFFSET, SCALE_WIDTH, TEXT_AA, TEXT_COLOUR
+from constants import ANCHOR_FORCE, EDGE_COLOUR, EDGE_THICKNESS, \
+    GRAPH_ALPHA, GRAPH_COLOUR_LIST, ITERATION_MULTIPLIER, MAP_RASTER, \
+    PLACEMENT_CONSTANT, PLACEMENT_METHOD, OVERLAP_FORCE, SCALE_MARKER_SIZE, \
+    SCALE_SPACING, SCALE_TEXT_OFFSET, SCALE_WIDTH, TEXT_AA, TEXT_COLOUR
 
-import pygame, pygame.draw # We currently render using pygame...
+import pygame, pygame.draw, pygame.surfarray # We currently render using pygame...
 import shapefile # For the shape constants
+import numpy as np # For checking for missing values
+import functools
 
 # We define a helper function to round to n significant digits:
 # This is from: http://stackoverflow.com/questions/3410976/how-to-round-a-number-to-significant-figures-in-python
@@ -37,8 +45,26 @@ def round_sf(v, n):
             return int(rounded)
         return rounded
 
+def cache_labels(func):
+    """ Wrap the given method to cache its result in the instance's labels
+        dict, so that the cached labels are freed with the widget.
+        Only the result for the most recent arguments (the size) is kept, as
+        the labels for any other size will not be used until the widget is
+        resized again.
+    """
+    @functools.wraps(func)
+    def cacher(self, *args):
+        cached = self.labels.get(func.__name__)
+        if cached == None or cached[0] != args:
+            cached = (args, func(self, *args))
+            self.labels[func.__name__] = cached
+        return cached[1]
+    return cacher
+
 class TextWidget():
     """ A static, left aligned text widget """
+
+    dynamic = False
     
     def __init__(self, text, font):
         """ Initialise self """
@@ -75,6 +101,8 @@ class TextWidget():
         
 class DynamicTextWidget(TextWidget):
     """ A dynamic, left aligned text widget """
+
+    dynamic = True
     
     def __init__(self, text_func, font):
         """ Initialise self """
@@ -106,6 +134,8 @@ class DynamicTextWidget(TextWidget):
 
 class ScaleWidget():
     """ A dynamically sized widget representing a scale """
+
+    dynamic = False
     
     def __init__(self, domain, sf, font):
         """ Initialise self """
@@ -137,10 +167,11 @@ class ScaleWidget():
         
         # Save the values.
         self.font = font # The font to use.
-        self.value2colour = domain.value2colour
+        self.values2colours = domain.values2colours
         self.labelling = labelling # Scale labelling function.
         self.row2value = row2value # Row to value conversion function.
         self.size = None # The scale is *mostly* dynamically sized.
+        self.labels = {} # Cached labels; see cache_labels.
 
     def render(self, surface, time, pos_func, size):
         """ Render self """
@@ -154,25 +185,19 @@ class ScaleWidget():
         # Calculate the base height.
         base_height = y_offset + size[1] - (self.font.get_linesize() / 2)
         
-        # Render the values, and save them.
-        rows = {} # row: text
-        max_text_width = 0 # Record the maximum text width for future reference.
-        for row, value in self.labelling(height).items():
-            # Render and save.
-            rows[row] = self.font.render(value, TEXT_AA, TEXT_COLOUR)
-            # Update the maximum text width.
-            max_text_width = max(rows[row].get_width(), max_text_width)
+        # Render the values, and find where to place them.
+        rows, max_text_width, placement = self.gen_labels(height)
 
         # Calculate the maximum x border of the scale.
         max_x = min((min_x + size[0]) - (max_text_width + SCALE_TEXT_OFFSET), \
             min_x + SCALE_WIDTH)
 
         # Draw the scale.
-        for row in range(height + 1):
+        colours = self.values2colours([self.row2value(row, height) \
+            for row in range(height + 1)]).tolist()
+        for row, colour in enumerate(colours):
             # Calculate the height to draw the row at.
             y = base_height - row
-            # Calculate the colour for this row.
-            colour = self.value2colour(self.row2value(row, height))
             # Draw the row.
             pygame.draw.line(surface, colour, (min_x, y), (max_x, y))
             
@@ -181,14 +206,6 @@ class ScaleWidget():
             max_x - min_x, height)]
 
         # Blit the rendered text onto the scale.
-        # We start by using 'place' to generate a list of placements for the
-        # labels so that they do not overlap.
-        # placement is a map from anchors (rows) to actual placement points.
-        label_area = (-(self.font.get_linesize() / 2), \
-            height + (self.font.get_linesize() / 2))
-        placement = place(label_area, \
-            {row: text.get_height() for row, text in rows.items()})
-        # Now we actually blit the text onto the scale.
         for row, text in rows.items():
             # Calculate the y offset for the label.
             y = base_height - placement[row] - (text.get_height() / 2)
@@ -202,22 +219,68 @@ class ScaleWidget():
                 (max_x + SCALE_MARKER_SIZE, y))
                 
         return merge_rects(dirty)
+
+    @cache_labels
+    def gen_labels(self, height):
+        """ Render the labels for the given height, returning the rendered
+            text (a map from rows to text), the maximum text width, and the
+            placement of the labels (a map from rows to placement points).
+            The labels only depend on the height, so they are cached.
+        """
+        
+        # Render the values, and save them.
+        rows = {} # row: text
+        max_text_width = 0 # Record the maximum text width for future reference.
+        for row, value in self.labelling(height).items():
+            # Render and save.
+            rows[row] = self.font.render(value, TEXT_AA, TEXT_COLOUR)
+            # Update the maximum text width.
+            max_text_width = max(rows[row].get_width(), max_text_width)
+
+        # We use 'place' to generate a list of placements for the labels so
+        # that they do not overlap.
+        # placement is a map from anchors (rows) to actual placement points.
+        label_area = (-(self.font.get_linesize() / 2), \
+            height + (self.font.get_linesize() / 2))
+        placement = place(label_area, \
+            {row: text.get_height() for row, text in rows.items()})
+
+        return rows, max_text_width, placement
         
 
 class ValuesWidget():
     """ Widget for a specific Values """
+
+    dynamic = True
     
-    def __init__(self, values, edge_render):
-        """ Initialise self """
+    def __init__(self, values, edge_render, raster = MAP_RASTER):
+        """ Initialise self.
+            If raster is True, the patches are drawn once into an image of
+            patch indexes, and each frame is filled in from that image by
+            looking up the colour of each patch.
+        """
 
         self.size = None # This widget is dynamically sized.
         self.values = values
         self.model = values.model
         self.edge_render = edge_render
-        
-    def gen_transform(self, pos_func, size):
-        """ Generate a transformation function to adjust the points in the
-            model.
+        self.raster = raster
+        # The patches, and the column of each patch (or -1 if it is missing).
+        self.patches = list(self.model.patches)
+        self.columns = np.array([self.model.patch_index.get(patch, -1) \
+            for patch in self.patches], dtype=int)
+        # The cached projected polygons, and the (size, offset) they are for.
+        self.geometry = None
+        self.geometry_key = None
+        # The cached patch index image, as generated by gen_raster.
+        self.index_image = None
+        # The cached edge overlay, as generated by gen_edges.
+        self.edges = None
+        
+    def gen_geometry(self, pos_func, size):
+        """ Return a map from patches to lists of polygons (one per part) in
+            screen coordinates, reusing the cached polygons unless the size
+            or offset has changed.
         """
 
         # Save the shorter name for the model...
@@ -231,83 +294,126 @@ class ValuesWidget():
         # Calculate the offset with the *real* size.
         real_size = [model.size[i] * scale for i in range(2)]
         offset = pos_func(real_size)
-        
-        def transform(vert):
-            # Calculate a scaled and recentered vertex.
-            point = [(vert[i] - model.center[i]) * scale for i in range(2)]
-            
-            # Transform the recentered vertex into offset pygame coordinates.
-            return ((real_size[0] / 2) + point[0] + offset[0], \
-                (real_size[1] / 2) - point[1] + offset[1])
+
+        # Project the patches, if required.
+        key = (tuple(size), tuple(offset))
+        if key != self.geometry_key:
+            self.geometry = {patch: project_shape(model.patches[patch]['shape'], \
+                    model.center, scale, real_size, offset) \
+                for patch in model.patches}
+            self.geometry_key = key
+            self.index_image = None
+            self.edges = None
             
-        return transform
-        
+        return self.geometry
         
     def render(self, surface, time, pos_func, size):
-        """ Render the given values class onto a surface """
+        """ Render the given values class onto a surface, returning the area
+            covered by the map. The edges may extend slightly past that area.
+        """
+        return self.render_map(surface, time, pos_func, size)[0]
+
+    def render_dynamic(self, surface, time, pos_func, size):
+        """ Render the given values class onto a surface, returning the rect
+            changed, including the edges.
+        """
+        return self.render_map(surface, time, pos_func, size)[1]
+
+    def render_map(self, surface, time, pos_func, size):
+        """ Render the given values class onto a surface, returning the area
+            covered by the map and the rect changed.
+        """
         
         # Dirty rects.
         dirty = []
         
-        # Transform function.
-        trans = self.gen_transform(pos_func, size)
-    
-        # Render patches.
-        for patch in self.model.patches:
-            try:
-                value = self.values.values[time][patch]
-                colour = self.values.domain.value2colour(value)
-            except KeyError:
-                # We currently ignore this, to avoid spamming the console.
-                colour = BROKEN_COLOUR
-            # Render the filled patch.
-            dirty += self.render_shape(surface, trans, \
-                self.model.patches[patch]['shape'], colour, 0)
-            # Render edges as required (not filled, just for the outlines).
-            if self.edge_render:
-                self.render_shape(surface, trans, \
-                    self.model.patches[patch]['shape'], EDGE_COLOUR, \
-                    EDGE_THICKNESS)
+        # Projected polygons.
+        geometry = self.gen_geometry(pos_func, size)
+
+        # Use the patch index image, if possible. This needs direct access to
+        # the surface's pixels.
+        if self.raster and surface.get_bytesize() in (3, 4):
+            rect = self.render_raster(surface, time, geometry)
+        else:
+            # Render patches.
+            colours = self.patch_colours(time).tolist()
+            for patch, colour in zip(self.patches, colours):
+                # Render the filled patch.
+                dirty += self.render_shape(surface, geometry[patch], colour, 0)
+            rect = merge_rects(dirty)
+
+        edge_rect = self.render_edges(surface, geometry)
+        if edge_rect != None and rect != None:
+            return rect, rect.union(edge_rect)
+        return rect, rect
+
+    def render_raster(self, surface, time, geometry):
+        """ Render the given values class onto a surface, using the patch
+            index image, returning the area covered.
+        """
+
+        if self.index_image == None:
+            self.index_image = gen_raster(geometry, self.patches)
+        rect, patches, indexes = self.index_image
+        
+        # Find the colour of each patch; the image refers to the patches
+        # by their index in the list of patches.
+        colours = self.patch_colours(time)
+
+        # Fill in the covered pixels of the part of the image on the surface.
+        # Uncovered pixels (-1) get the last colour, but are not copied.
+        clipped = rect.clip(surface.get_rect())
+        if clipped.width > 0 and clipped.height > 0:
+            area = indexes[clipped.left - rect.left:clipped.right - rect.left,
+                clipped.top - rect.top:clipped.bottom - rect.top]
+            if surface.get_bytesize() == 4:
+                # Copy whole (mapped) pixels at once.
+                pixels = pygame.surfarray.pixels2d(surface)
+                colours = map_colours(surface, colours)
+                covered = area >= 0
+            else:
+                pixels = pygame.surfarray.pixels3d(surface)
+                covered = (area >= 0)[:, :, None]
+            np.copyto(pixels[clipped.left:clipped.right, \
+                clipped.top:clipped.bottom], colours[area], where = covered)
+            del pixels # Unlock the surface.
             
-        return merge_rects(dirty)
+        return rect.copy()
+
+    def render_edges(self, surface, geometry):
+        """ Render edges as required (not filled, just for the outlines).
+            The edges do not change between frames, so they are drawn once
+            onto a transparent overlay, which is then blitted over the map.
+            Returns the rect rendered to, or None.
+        """
+
+        if self.edge_render:
+            if self.edges == None:
+                self.edges = gen_edges(geometry, self.patches, \
+                    lambda surface, polygons: self.render_shape(surface, \
+                        polygons, EDGE_COLOUR, EDGE_THICKNESS))
+            offset, overlay = self.edges
+            return surface.blit(overlay, offset)
+        return None
+
+    def patch_colours(self, time):
+        """ Return an array of the colours of each of self's patches at the
+            given time.
+        """
+
+        # Missing patches get the NaN at the end of the row.
+        # We currently ignore missing values, to avoid spamming the
+        # console; they are rendered as BROKEN_COLOUR.
+        values = np.append(self.values.values[time], np.nan)
+        return self.values.domain.values2colours(values[self.columns])
             
-    def render_shape(self, surface, transform, shape, colour, width):
-        """ Render the given shape onto the given surface, applying the given
-            transformation. If width == 0, then the shape will be filled.
+    def render_shape(self, surface, polygons, colour, width):
+        """ Render the given projected polygons onto the given surface.
+            If width == 0, then the polygons will be filled.
         """
         
-        # This is not the shape you are looking for!
-        if shape.shapeType != shapefile.POLYGON and \
-            shape.shapeType != shapefile.NULL:
-            # If this happens, you will probably need to go and investigate the
-            # spec:
-            # http://www.esri.com/library/whitepapers/pdfs/shapefile.pdf
-            # Basically, there are many supported shapes, but I only expect to
-            # encounter POLYGON's in a GIS file, and so have only written a
-            # rendering routine for those.
-            # The library that we are using doesn't have much documentation, so
-            # dir() and help() are your friends, or the source, which is online
-            # at https://github.com/GeospatialPython/pyshp.
-            # Also, pygame has some helpful routines for rendering shapes which
-            # might come in handy.
-            # Hopefully this never stops working!
-            raise ValueError("Unknown shape type {}!".format(shape.shapeType))
-
         dirty = [] # List of dirty rects.
-            
-        if shape.shapeType == shapefile.NULL:
-            # Nothing to render...
-            return dirty
-        
-        # We have a polygon!
-        # Polygons are made of different "parts", which are ordered sets of
-        # points that are assumed to join up, so we render them part-by-part.
-        for num, part in enumerate(shape.parts):
-            if num + 1 >= len(shape.parts):
-                end = len(shape.points)
-            else:
-                end = shape.parts[num + 1]
-            points = [transform(point) for point in shape.points[part:end]]
+        for points in polygons:
             if width != 1:
                 dirty.append(pygame.draw.polygon(surface, colour, points, \
                     width))
@@ -317,15 +423,146 @@ class ValuesWidget():
                     points, width))
                 
         return dirty
+
+
+def map_colours(surface, colours):
+    """ Convert an array of RGB colours to the matching pixel values for the
+        given surface, as surface.map_rgb does for a single colour.
+    """
+
+    colours = colours.astype(np.uint32)
+    pixels = np.zeros(colours.shape[:-1], dtype=np.uint32)
+    for i, (shift, loss) in enumerate(zip(surface.get_shifts()[:3], \
+            surface.get_losses()[:3])):
+        pixels |= (colours[..., i] >> np.uint32(loss)) << np.uint32(shift)
+    # Opaque, if the surface has an alpha channel.
+    pixels |= np.uint32(surface.get_masks()[3] & 0xFFFFFFFF)
+    return pixels
+
+def gen_raster(geometry, patches):
+    """ Rasterise the given projected patches (a map from patches to lists of
+        polygons, as returned by ValuesWidget.gen_geometry), returning the
+        area covered (a Rect), the list of patches, and a (x, y) array of the
+        index of the patch covering each pixel in that area (or -1).
+        Later patches are drawn over earlier ones.
+    """
+
+    # Find the area covered by the patches.
+    left, top, right, bottom = geometry_bounds(geometry, patches)
+    if right <= left:
+        return pygame.Rect(0, 0, 0, 0), patches, np.empty((0, 0), dtype=int)
+
+    # Draw each patch in a unique colour (the patch index plus one, so that
+    # black is left for uncovered pixels), offset so that the area starts at
+    # (0, 0).
+    surface = pygame.Surface((right - left, bottom - top), 0, 24)
+    surface.fill((0, 0, 0))
+    dirty = []
+    for index, patch in enumerate(patches):
+        colour = ((index + 1) >> 16, ((index + 1) >> 8) & 255, \
+            (index + 1) & 255)
+        for polygon in geometry[patch]:
+            dirty.append(pygame.draw.polygon(surface, colour, \
+                [(x - left, y - top) for x, y in polygon]))
+    
+    # Decode the colours into patch indexes.
+    pixels = pygame.surfarray.array3d(surface).astype(int)
+    indexes = (((pixels[:, :, 0] << 16) | (pixels[:, :, 1] << 8) | \
+        pixels[:, :, 2]) - 1).astype(np.int32)
+    rect = merge_rects(dirty).move(left, top)
+    return rect, patches, indexes
+
+def gen_edges(geometry, patches, render_shape):
+    """ Draw the edges of the given projected patches onto a transparent
+        surface, returning the surface and the offset to blit it at.
+        render_shape is called with a surface and the polygons of each patch
+        to draw that patch's edges.
+    """
+
+    # Find the area covered by the patches, with some space for the lines.
+    left, top, right, bottom = geometry_bounds(geometry, patches)
+    left, top, right, bottom = left - EDGE_THICKNESS, top - EDGE_THICKNESS, \
+        right + EDGE_THICKNESS, bottom + EDGE_THICKNESS
+
+    # Draw the edges, offset so that the area starts at (0, 0).
+    surface = pygame.Surface((max(right - left, 0), max(bottom - top, 0)), \
+        pygame.SRCALPHA, 32)
+    surface.fill((0, 0, 0, 0))
+    for patch in patches:
+        render_shape(surface, [[(x - left, y - top) for x, y in polygon] \
+            for polygon in geometry[patch]])
+    return (left, top), surface
+
+def geometry_bounds(geometry, patches):
+    """ Return the (left, top, right, bottom) bounds of the pixels covered by
+        the given projected patches.
+    """
+
+    points = [point for patch in patches for polygon in geometry[patch] \
+        for point in polygon]
+    if len(points) == 0:
+        return 0, 0, 0, 0
+    points = np.array(points)
+    left, top = np.floor(points.min(axis=0)).astype(int)
+    right, bottom = np.floor(points.max(axis=0)).astype(int) + 2
+    return int(left), int(top), int(right), int(bottom)
+
+def project_shape(shape, center, scale, real_size, offset):
+    """ Project the given shape into screen coordinates, returning a list of
+        polygons (lists of points), one for each part.
+        center is the model's center, scale the scaling factor, and real_size
+        and offset the size and position of the scaled model on the surface.
+    """
+        
+    # This is not the shape you are looking for!
+    if shape.shapeType != shapefile.POLYGON and \
+        shape.shapeType != shapefile.NULL:
+        # If this happens, you will probably need to go and investigate the
+        # spec:
+        # http://www.esri.com/library/whitepapers/pdfs/shapefile.pdf
+        # Basically, there are many supported shapes, but I only expect to
+        # encounter POLYGON's in a GIS file, and so have only written a
+        # rendering routine for those.
+        # The library that we are using doesn't have much documentation, so
+        # dir() and help() are your friends, or the source, which is online
+        # at https://github.com/GeospatialPython/pyshp.
+        # Also, pygame has some helpful routines for rendering shapes which
+        # might come in handy.
+        # Hopefully this never stops working!
+        raise ValueError("Unknown shape type {}!".format(shape.shapeType))
+
+    if shape.shapeType == shapefile.NULL or len(shape.points) == 0:
+        # Nothing to render...
+        return []
+
+    # Calculate a scaled and recentered version of every vertex, and then
+    # transform them into offset pygame coordinates (y is flipped).
+    points = (np.array(shape.points, dtype=float)[:, :2] - center) * scale
+    points[:, 0] = (real_size[0] / 2) + points[:, 0] + offset[0]
+    points[:, 1] = (real_size[1] / 2) - points[:, 1] + offset[1]
+        
+    # We have a polygon!
+    # Polygons are made of different "parts", which are ordered sets of
+    # points that are assumed to join up, so we split them part-by-part.
+    return [part.tolist() for part in np.split(points, list(shape.parts)[1:])]
+
         
 class GraphWidget():
     """ Widget for realtime graphs of a list of given Graphables """
+
+    dynamic = True
     
     def __init__(self, graph, dates, sf, font):
         """ Initialise self """
         
         # Check that we have enough colours defined.
-        if len(graph.graphables) > len(GRAPH_COLOUR_LIST):
+        # Envelopes are coloured by statistic rather than by graphable.
+        self.envelope = graph.envelope
+        if self.envelope:
+            lines = len(graph.graphables[0].statistics)
+        else:
+            lines = len(graph.graphables)
+        if lines > len(GRAPH_COLOUR_LIST):
             raise ValueError("To many lines specified; not enough colours!")
         
         # Save some of the given values.
@@ -335,37 +572,78 @@ class GraphWidget():
         self.font = font
         self.size = None
         self.sf = sf
+        self.labels = {} # Cached labels; see cache_labels.
         
         # The 'global' minimum and maximum.
         self.min = graph.domain.min
         self.max = graph.domain.max
         
+        # The graph area and row2date function for the last rendered scale,
+        # and the position and size that they are for.
+        self.plot = None
+        self.plot_key = None
+        # A copy of the rendered static part of the graph, for render, with
+        # the position and size that it is for, and the area it covers.
+        self.cache = None
+        
     def render(self, surface, time, pos_func, size):
         """ Render the given graphable class onto a surface """
+
+        # The static part does not change, so copy it from the cache if it
+        # has already been rendered.
+        key = (tuple(pos_func(size)), tuple(size))
+        if self.cache != None and self.cache[0] == key:
+            key, rect, cached = self.cache
+            surface.blit(cached, rect.topleft)
+        else:
+            rect = self.render_static(surface, pos_func, size).clip( \
+                surface.get_rect())
+            self.cache = (key, rect, surface.subsurface(rect).copy())
+        self.render_dynamic(surface, time, pos_func, size)
+        return rect.copy()
+
+    def render_static(self, surface, pos_func, size):
+        """ Render the parts of the graph that do not change with time; the
+            scale, and the lines.
+        """
         
         topleft = pos_func(size)
-        dirty = pygame.Rect(topleft, size)
         
         # We start by rendering a scale...
         scale_size = [0, 0]
-        row2date, scale_size[0], scale_size[1] = \
+        row2date, scale_size[0], scale_size[1], dirty = \
             self.render_scale(surface, topleft, size)
+        self.plot_key = (tuple(topleft), tuple(size))
         size = [size[i] - scale_size[i] for i in range(2)]
         topleft = (topleft[0] + scale_size[0], topleft[1])
+        self.plot = (topleft, size, row2date)
         
         # We render the lines.
-        # Render the line.
-        for index, graph in enumerate(self.graphable):
-            self.render_line(surface, graph, GRAPH_COLOUR_LIST[index], \
-                topleft, size, row2date)
+        if self.envelope:
+            self.render_envelope(surface, topleft, size, row2date)
+        else:
+            for index, graph in enumerate(self.graphable):
+                self.render_line(surface, graph, GRAPH_COLOUR_LIST[index], \
+                    topleft, size, row2date)
+
+        return dirty
+
+    def render_dynamic(self, surface, time, pos_func, size):
+        """ Render the parts of the graph that change with time; the time
+            marker.
+        """
+
+        topleft = pos_func(size)
+        if self.plot_key != (tuple(topleft), tuple(size)):
+            # We need the scale's layout, so render it.
+            self.render_static(surface, pos_func, size)
+        topleft, size, row2date = self.plot
         
         offset = ((float(time) / (len(self.dates) - 1)) * size[0]) + \
             topleft[0]
-        pygame.draw.line(surface, TEXT_COLOUR, (offset, topleft[1]), \
+        return pygame.draw.line(surface, TEXT_COLOUR, (offset, topleft[1]), \
             (offset, topleft[1] + size[1]))
         
-        return dirty
-        
     def render_scale(self, surface, topleft, size):
         """ Render the scale """
         
@@ -373,67 +651,40 @@ class GraphWidget():
         #       within the labelling routines. It would be nice if I could
         #       figure out how to remove that.
         
+        # The rects rendered to; labels may be rendered outside of the given
+        # area.
+        dirty = [pygame.Rect(topleft, size)]
+
         # We start by generating and rendering some labels.
         line_space = self.font.get_linesize()
         date_height = line_space + SCALE_TEXT_OFFSET
         height = size[1] - (date_height + line_space)
-        anchors = gen_labelling(height - 1, line_space, line_space)
-        # We then render the labels.
-        rows = {} # The rendered text (row: text)
-        max_text_width = 0 # Record the maximum text width for future reference.
-        for row in anchors:
-            # Render and save.
-            value = str(round_sf((float(row) / height) * \
-                (self.max - self.min) + self.min, self.sf))
-            rows[row] = self.font.render(value, TEXT_AA, TEXT_COLOUR)
-            # Update the maximum text width.
-            max_text_width = max(rows[row].get_width(), max_text_width)
+        rows, max_text_width, placement = self.gen_value_labels(height)
         # Figure out the vertical scale line location (we use it for rendering
         # markers).
         width = SCALE_TEXT_OFFSET + max_text_width
         x_offset = topleft[0] + width
-        # We generate a list of placements for the labels so that they do not
-        # overlap.
-        # placement is a map from anchors (rows) to actual placement points.
-        label_area = (-(line_space / 2), height + (line_space / 2))
-        placement = place(label_area, \
-            {row: text.get_height() for row, text in rows.items()})
         # Now we actually blit the text onto the scale.
         for row, text in rows.items():
             # Calculate the y offset for the label.
             y = topleft[1] + height - placement[row] - (text.get_height() / 2)
             # Blit the text onto the surface.
-            surface.blit(text, (topleft[0], y))
+            dirty.append(surface.blit(text, (topleft[0], y)))
             # Calculate the y offset for the marker.
             y = topleft[1] + height - 1 - row
             # Draw a marker.
             pygame.draw.line(surface, TEXT_COLOUR, \
                 (x_offset - SCALE_MARKER_SIZE, y), (x_offset, y))
         
-        # Generate a row2date function (reused elsewhere).
-        graph_width = size[0] - width
-        row2date = lambda row: int(float(row * (len(self.dates) - 1)) / \
-            graph_width)
-                
         # Render the dates.
-        # First, generate the anchor locations.
-        anchors = gen_labelling(graph_width - 1, \
-            self.font.render(self.dates[0], TEXT_AA, TEXT_COLOUR).get_width(), \
-            SCALE_SPACING, label_count=len(self.dates))
-        # Render the text at those points.
-        rows = {}
-        for row in anchors:
-            rows[row] = self.font.render(self.dates[row2date(row)], TEXT_AA, \
-                TEXT_COLOUR)
-        # Then, generate a map of placements (anchors: placement map)
-        placement = place((-(SCALE_SPACING / 2), graph_width + \
-            (SCALE_SPACING / 2)), {row: text.get_width() + SCALE_SPACING \
-                for row, text in rows.items()})
-        # Finally, blit the text onto the scale.
+        graph_width = size[0] - width
+        row2date, rows, placement = self.gen_date_labels(graph_width)
+        # Blit the text onto the scale.
         for row, text in rows.items():
             x = topleft[0] + width
-            surface.blit(text, (x + placement[row] - (text.get_width() / 2), \
-                topleft[1] + height + SCALE_TEXT_OFFSET))
+            dirty.append(surface.blit(text, (x + placement[row] - \
+                (text.get_width() / 2), topleft[1] + height + \
+                SCALE_TEXT_OFFSET)))
             pygame.draw.line(surface, TEXT_COLOUR, \
                 (x + row, topleft[1] + height), \
                 (x + row, topleft[1] + height + SCALE_MARKER_SIZE))
@@ -447,45 +698,164 @@ class GraphWidget():
                 
         # Draw the key underneath, if required.
         y = topleft[1] + size[1]
-        label = self.font.render(self.label, TEXT_AA, TEXT_COLOUR)
+        label, labels = self.gen_key_labels()
         rect = surface.blit(label, (topleft[0], y - label.get_height()))
+        dirty.append(rect.copy())
         # Render the labels for the individual graphs.
         offset = rect.right + SCALE_SPACING
-        for index, graph in enumerate(self.graphable):
+        for label in labels:
             # TODO: Render this using 'place'.
-            label = self.font.render(graph.label, TEXT_AA, \
-                GRAPH_COLOUR_LIST[index])
-            surface.blit(label, (offset, y - label.get_height()))
+            dirty.append(surface.blit(label, (offset, \
+                y - label.get_height())))
             offset += label.get_width() + SCALE_SPACING
     
-        return row2date, width + 1, size[1] - (height - 1)
+        return row2date, width + 1, size[1] - (height - 1), merge_rects(dirty)
+
+    # The labels only depend on the size, so they are cached.
+
+    @cache_labels
+    def gen_value_labels(self, height):
+        """ Render the value labels for the given height, returning the
+            rendered text (a map from rows to text), the maximum text width,
+            and the placement of the labels (a map from rows to placement
+            points).
+        """
+
+        line_space = self.font.get_linesize()
+        anchors = gen_labelling(height - 1, line_space, line_space)
+        # We then render the labels.
+        rows = {} # The rendered text (row: text)
+        max_text_width = 0 # Record the maximum text width for future reference.
+        for row in anchors:
+            # Render and save.
+            value = str(round_sf((float(row) / height) * \
+                (self.max - self.min) + self.min, self.sf))
+            rows[row] = self.font.render(value, TEXT_AA, TEXT_COLOUR)
+            # Update the maximum text width.
+            max_text_width = max(rows[row].get_width(), max_text_width)
+        # We generate a list of placements for the labels so that they do not
+        # overlap.
+        # placement is a map from anchors (rows) to actual placement points.
+        label_area = (-(line_space / 2), height + (line_space / 2))
+        placement = place(label_area, \
+            {row: text.get_height() for row, text in rows.items()})
+        return rows, max_text_width, placement
+
+    @cache_labels
+    def gen_date_labels(self, graph_width):
+        """ Render the date labels for the given graph width, returning a
+            row2date function, the rendered text (a map from rows to text),
+            and the placement of the labels.
+        """
+
+        # Generate a row2date function (reused elsewhere).
+        row2date = lambda row: int(float(row * (len(self.dates) - 1)) / \
+            graph_width)
+                
+        # First, generate the anchor locations.
+        anchors = gen_labelling(graph_width - 1, \
+            self.font.render(self.dates[0], TEXT_AA, TEXT_COLOUR).get_width(), \
+            SCALE_SPACING, label_count=len(self.dates))
+        # Render the text at those points.
+        rows = {}
+        for row in anchors:
+            rows[row] = self.font.render(self.dates[row2date(row)], TEXT_AA, \
+                TEXT_COLOUR)
+        # Then, generate a map of placements (anchors: placement map)
+        placement = place((-(SCALE_SPACING / 2), graph_width + \
+            (SCALE_SPACING / 2)), {row: text.get_width() + SCALE_SPACING \
+                for row, text in rows.items()})
+        return row2date, rows, placement
+
+    @cache_labels
+    def gen_key_labels(self):
+        """ Render the key's label, and the labels for each line """
+
+        label = self.font.render(self.label, TEXT_AA, TEXT_COLOUR)
+        if self.envelope:
+            # Label the envelopes for each statistic.
+            labels = ["{} (range of {})".format(stat, len(self.graphable)) \
+                for stat in self.graphable[0].statistics]
+        else:
+            labels = [graph.label for graph in self.graphable]
+        return label, [self.font.render(text, TEXT_AA, \
+                GRAPH_COLOUR_LIST[index]) \
+            for index, text in enumerate(labels)]
 
     def render_line(self, surface, graph, colour, topleft, size, row2date):
-        """ Render a line onto the given surface """
-        
-        # Define a helper function to find the y-coord.
-        # This scales and offsets the given value as required.
-        def y(value):
-            try:
-                perc = ((value - self.min) / (self.max - self.min))
-            except ZeroDivisionError:
-                perc = 0
-            return topleft[1] + size[1] - (size[1] * perc)
-
-        old = graph[0]
-        for i in range(size[0]):
-            # Find the current position to draw to.
-            cur = graph[row2date(i)]
-            # Draw the lines.
-            x = topleft[0] + i
-            for index in range(len(cur)):
-                pygame.draw.aaline(surface, colour, \
-                    (x - 1, y(old[index])), \
-                    (x, y(cur[index])))
-            # Save the current position.
-            old = cur
+        """ Render a line for each of the graph's statistics onto the given
+            surface.
+        """
+
+        # Each line starts one pixel before the graph, at the first value.
+        xs, rows = self.line_points(topleft, size, row2date)
+        for ys in self.value2y(graph.values[:, rows], topleft, size):
+            draw_lines(surface, colour, xs, ys)
+
+    def render_envelope(self, surface, topleft, size, row2date):
+        """ Render a shaded band from the minimum to the maximum of the
+            graphables, and the edges of that band, for each statistic.
+        """
+
+        xs, rows = self.line_points(topleft, size, row2date)
+        # Find the (statistic, column) minimums and maximums.
+        values = np.array([graph.values[:, rows] for graph in self.graphable])
+        lows = self.value2y(np.fmin.reduce(values, axis=0), topleft, size)
+        highs = self.value2y(np.fmax.reduce(values, axis=0), topleft, size)
+
+        # The band is shaded on a separate (transparent) surface.
+        left = xs[0]
+        band = pygame.Surface((len(xs), size[1] + 1), pygame.SRCALPHA, 32)
+        for index, (low, high) in enumerate(zip(lows, highs)):
+            colour = GRAPH_COLOUR_LIST[index]
+            band.fill((0, 0, 0, 0))
+            for start, stop in finite_runs(low):
+                # Go along the top, and back along the bottom.
+                points = np.concatenate(( \
+                    np.column_stack((xs[start:stop], high[start:stop])), \
+                    np.column_stack((xs[start:stop], low[start:stop]))[::-1]))
+                points -= (left, topleft[1])
+                pygame.draw.polygon(band, tuple(colour) + (GRAPH_ALPHA,), \
+                    points.tolist())
+            surface.blit(band, (left, topleft[1]))
+            draw_lines(surface, colour, xs, low)
+            draw_lines(surface, colour, xs, high)
+
+    def line_points(self, topleft, size, row2date):
+        """ Return the x coordinates of the points on a line, and the rows
+            for each point.
+        """
+        xs = np.arange(-1, size[0]) + topleft[0]
+        rows = [0] + [row2date(i) for i in range(size[0])]
+        return xs, rows
+
+    def value2y(self, values, topleft, size):
+        """ Convert from an array of values to y coordinates """
+        # This scales and offsets the given values as required.
+        if self.max > self.min:
+            perc = (values - self.min) / (self.max - self.min)
+        else:
+            perc = np.zeros(values.shape)
+        return topleft[1] + size[1] - (size[1] * perc)
      
 
+def finite_runs(values):
+    """ Return a list of (start, stop) pairs for the runs of finite values
+        in the given array.
+    """
+    valid = np.concatenate(([0], np.isfinite(values).astype(int), [0]))
+    edges = np.flatnonzero(np.diff(valid))
+    return list(zip(edges[::2], edges[1::2]))
+
+def draw_lines(surface, colour, xs, ys):
+    """ Draw an antialiased line through the given points, skipping any
+        missing (NaN) points.
+    """
+    for start, stop in finite_runs(ys):
+        if stop - start > 1:
+            pygame.draw.aalines(surface, colour, False, \
+                np.column_stack((xs[start:stop], ys[start:stop])).tolist())
+
 def gen_labelling(size, label_size, spacing, label_count=float('inf')):
     """ Generate a labelling for the given size linear area.
         This returns a list of rows for placing the labels on.
@@ -504,7 +874,7 @@ def gen_labelling(size, label_size, spacing, label_count=float('inf')):
     # Return an evenly spaced set of marks.
     return ((float(size) / (markers - 1)) * mark for mark in range(markers))
     
-def place(size, labels):
+def place(size, labels, method = PLACEMENT_METHOD):
     """ Try to optimise the placement of a given set of labels so that they
         are close to their anchor, but not overlapping and not outside of
         the total area.
@@ -512,6 +882,72 @@ def place(size, labels):
         are assumed to be in the centers of the given sizes.
         The given size is assumed to be a range from the minimum to the maximum
         pos.
+        method is either 'sweep' (see place_sweep) or 'force' (see
+        place_force).
+        This returns a map from anchors to placements (the label centers).
+    """
+
+    if method == 'sweep':
+        return place_sweep(size, labels)
+    elif method == 'force':
+        return place_force(size, labels)
+    raise ValueError("Unknown placement method {}!".format(method))
+
+def place_sweep(size, labels):
+    """ Place the labels by sweeping through them in order, packing any
+        overlapping labels into blocks as close as possible (by the sum of the
+        squared distances) to their anchors, and then clamping the blocks to
+        the given size (squashing the labels together if they do not fit).
+        This is deterministic, never leaves labels overlapping (unless they
+        are squashed), and takes O(n log n) time.
+    """
+
+    # Sort the labels, and find the offset of each label's center from the
+    # start of the labels if they were packed together.
+    anchors = sorted(labels.keys())
+    offsets = []
+    total = 0
+    for anchor in anchors:
+        offsets.append(total + (labels[anchor] / 2.0))
+        total += labels[anchor]
+
+    # If the labels do not fit, squash them together so that they do; this
+    # only eats into the spacing included in the label sizes, unless the
+    # labels are far too large.
+    if total > size[1] - size[0]:
+        scale = float(size[1] - size[0]) / total
+        offsets = [offset * scale for offset in offsets]
+        total = size[1] - size[0]
+
+    # Find the best start for every label, where the starts cannot decrease
+    # (so the labels cannot overlap). Each block is a list of the total of
+    # the starts wanted by the labels in the block, and the number of labels.
+    blocks = []
+    for anchor, offset in zip(anchors, offsets):
+        blocks.append([anchor - offset, 1])
+        # Merge the last two blocks while they overlap.
+        while len(blocks) > 1 and blocks[-2][0] / blocks[-2][1] >= \
+                blocks[-1][0] / blocks[-1][1]:
+            start, count = blocks.pop()
+            blocks[-1][0] += start
+            blocks[-1][1] += count
+
+    # Clamp the blocks to the given size, and place the labels.
+    placements = {}
+    index = 0
+    for start, count in blocks:
+        start = max(min(start / count, size[1] - total), size[0])
+        for anchor, offset in zip(anchors[index:index + count], \
+                offsets[index:index + count]):
+            placements[anchor] = start + offset
+        index += count
+    
+    return placements
+
+def place_force(size, labels):
+    """ Place the labels by iteratively applying forces pulling them back
+        towards their anchors, and pushing them away from overlapping labels
+        and the edges, until they settle.
     """
     
     # TODO: Add 'spacing' for the labels to avoid cludgy workarounds at the